@@ -1,6 +1,7 @@
 #!/bin/bash
 
 pep8-3 ypkg-build ypkg2/*.py ypkg-gen-history ypkg-install-deps ypkg || exit 1
+python3 -m unittest discover -s tests || exit 1
 #for item in examples/*.yml ; do
 #    python -m ypkg2.main $item || exit 1
 #done
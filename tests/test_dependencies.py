@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+from ypkg2.packages import PackageGenerator
+
+from unittest import mock
+import os
+import tempfile
+import unittest
+
+try:
+    from ypkg2 import dependencies
+except ImportError:
+    dependencies = None
+
+
+class Spec:
+
+    pkg_name = "zlib"
+    pkg_permanent = None
+    pkg_libsplit = True
+
+    def get_package_name(self, name):
+        if name == "main":
+            return self.pkg_name
+        return "{}-{}".format(self.pkg_name, name)
+
+
+class Build:
+
+    jobcount = 1
+
+
+class Context:
+
+    def __init__(self):
+        self.spec = Spec()
+        self.build = Build()
+
+
+class Report:
+    """ Bare examination results of a single file """
+
+    emul32 = False
+    rpaths = None
+    soname = None
+    symbol_deps = None
+    soname_links = None
+    pkgconfig_name = None
+    pkgconfig_deps = None
+    dep_kernel = None
+    prov_kernel = None
+
+    def __init__(self, pretty):
+        self.pretty = pretty
+
+
+class InstallDB:
+    """ Installed packages and the pkgconfig names they provide """
+
+    def __init__(self, provides):
+        self.provides = provides
+        self.reads = 0
+
+    def list_installed(self):
+        return sorted(self.provides)
+
+    def get_package(self, name):
+        self.reads += 1
+        return mock.Mock(providesPkgConfig=self.provides[name])
+
+
+@unittest.skipIf(dependencies is None, "inary is not available")
+class SonameLinkTest(unittest.TestCase):
+    """ .so links in -devel must pull in the package owning their target """
+
+    def get_resolver(self):
+        with mock.patch.object(dependencies, "InstallDB"), \
+                mock.patch.object(dependencies, "PackageDB"), \
+                mock.patch.object(dependencies, "FilesDB"), \
+                mock.patch.object(dependencies, "SonameIndex") as index:
+            index.return_value.load.return_value = False
+            return dependencies.DependencyResolver(
+                cache=dependencies.ResolverCache())
+
+    def test_solink(self):
+        ctx = Context()
+        gene = PackageGenerator(ctx.spec)
+        gene.add_file("/usr/lib64/libz.so.1")
+        gene.add_file("/usr/lib64/libz.so")
+
+        link = Report("/usr/lib64/libz.so")
+        link.soname_links = set(["/usr/lib64/libz.so.1"])
+        lib = Report("/usr/lib64/libz.so.1")
+        lib.soname = "libz.so.1"
+
+        resolver = self.get_resolver()
+        with mock.patch.object(dependencies, "get_installdb_stamp",
+                               return_value=(0, 0)):
+            self.assertTrue(resolver.compute_for_packages(
+                ctx, gene, {"main": [lib], "devel": [link]}))
+        self.assertEqual(gene.packages["devel"].depend_packages,
+                         set(["zlib"]))
+        self.assertEqual(gene.packages["main"].depend_packages, set())
+
+    def test_missing_target(self):
+        ctx = Context()
+        gene = PackageGenerator(ctx.spec)
+        gene.add_file("/usr/lib64/libz.so")
+
+        link = Report("/usr/lib64/libz.so")
+        link.soname_links = set(["/usr/lib64/libz.so.1"])
+
+        resolver = self.get_resolver()
+        with mock.patch.object(dependencies, "get_installdb_stamp",
+                               return_value=(0, 0)):
+            self.assertTrue(resolver.compute_for_packages(
+                ctx, gene, {"devel": [link]}))
+        self.assertEqual(gene.packages["devel"].depend_packages, set())
+
+
+@unittest.skipIf(dependencies is None, "inary is not available")
+class ScanTest(unittest.TestCase):
+    """ Full FilesDB scans only happen once for anything nothing provides """
+
+    def get_resolver(self):
+        with mock.patch.object(dependencies, "InstallDB"), \
+                mock.patch.object(dependencies, "PackageDB"), \
+                mock.patch.object(dependencies, "FilesDB"), \
+                mock.patch.object(dependencies, "SonameIndex") as index:
+            index.return_value.load.return_value = False
+            resolver = dependencies.DependencyResolver(
+                cache=dependencies.ResolverCache())
+        resolver.fdb.has_file.return_value = False
+        resolver.fdb.search_file.return_value = []
+        return resolver
+
+    def resolve(self, resolver, packageSet):
+        ctx = Context()
+        gene = PackageGenerator(ctx.spec)
+        with mock.patch.object(dependencies, "get_installdb_stamp",
+                               return_value=(0, 0)):
+            resolver.compute_for_packages(ctx, gene, packageSet)
+        return gene
+
+    def test_symbol(self):
+        binary = Report("/usr/bin/minigzip")
+        binary.symbol_deps = set(["libmissing.so.1"])
+        other = Report("/usr/bin/miniunzip")
+        other.symbol_deps = set(["libmissing.so.1"])
+        other.rpaths = set(["$ORIGIN"])
+
+        resolver = self.get_resolver()
+        self.resolve(resolver, {"main": [binary, other]})
+        scans = resolver.fdb.search_file.call_count
+        # Default search paths are shared, only $ORIGIN is scanned again
+        self.assertEqual(scans, 3)
+
+        self.resolve(resolver, {"main": [binary, other]})
+        self.assertEqual(resolver.fdb.search_file.call_count, scans)
+
+    def test_kernel(self):
+        module = Report("/usr/lib/modules/4.9.0/extra/zlib.ko")
+        module.dep_kernel = "4.9.0"
+
+        resolver = self.get_resolver()
+        self.resolve(resolver, {"main": [module]})
+        self.assertEqual(resolver.fdb.search_file.call_count, 2)
+
+        self.resolve(resolver, {"main": [module]})
+        self.assertEqual(resolver.fdb.search_file.call_count, 2)
+
+
+@unittest.skipIf(dependencies is None, "inary is not available")
+class PkgconfigIndexTest(unittest.TestCase):
+    """ Installed pkgconfig providers are only read once per InstallDB """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "pkgconfig.index")
+        self.idb = InstallDB({
+            "zlib-devel": ["zlib"],
+            "zlib-32bit-devel": ["zlib"],
+            "glib2-devel": ["glib-2.0", "gio-2.0"],
+            "nano": [],
+        })
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get_pkgconfigs(self, stamp):
+        from ypkg2 import sonameindex
+        cache = dependencies.ResolverCache(pkgconfig_path=self.path)
+        with mock.patch.object(sonameindex, "get_installdb_stamp",
+                               return_value=stamp):
+            return (cache.get_pkgconfigs(self.idb, False),
+                    cache.get_pkgconfigs(self.idb, True))
+
+    def test_persist(self):
+        native, emul32 = self.get_pkgconfigs((1, 4))
+        self.assertEqual(native, {"zlib": "zlib-devel",
+                                  "glib-2.0": "glib2-devel",
+                                  "gio-2.0": "glib2-devel"})
+        self.assertEqual(emul32, {"zlib": "zlib-32bit-devel"})
+        self.assertEqual(self.idb.reads, 4)
+
+        # Another build against the same InstallDB
+        self.assertEqual(self.get_pkgconfigs((1, 4)), (native, emul32))
+        self.assertEqual(self.idb.reads, 4)
+
+    def test_stale(self):
+        self.get_pkgconfigs((1, 4))
+        self.idb.provides["zlib-devel"] = ["zlib", "minizip"]
+        native, emul32 = self.get_pkgconfigs((2, 4))
+        self.assertEqual(native["minizip"], "zlib-devel")
+        self.assertEqual(self.idb.reads, 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+from ypkg2.elf import ElfFile, ElfError, ELFCLASS64, PT_DYNAMIC, PT_NOTE
+from ypkg2.elf import SHT_DYNSYM
+
+import os
+import struct
+import sys
+import unittest
+
+
+def read_host_binary():
+    """ Any dynamically linked ELF64 object will do, i.e. our interpreter """
+    path = os.path.realpath(sys.executable)
+    with open(path, "rb") as inp:
+        data = bytearray(inp.read())
+    if data[0:4] != b"\x7fELF" or data[4] != ELFCLASS64 or data[5] != 1:
+        return None
+    return data
+
+
+class MalformedElfTest(unittest.TestCase):
+    """ Corrupt headers must only ever surface as an ElfError """
+
+    def setUp(self):
+        self.data = read_host_binary()
+        if self.data is None:
+            self.skipTest("No little endian ELF64 interpreter to work on")
+
+    def point_segment_past_eof(self, ptype):
+        phoff, = struct.unpack_from("<Q", self.data, 32)
+        phentsize, phnum = struct.unpack_from("<HH", self.data, 54)
+        for i in range(0, phnum):
+            off = phoff + i * phentsize
+            if struct.unpack_from("<I", self.data, off)[0] == ptype:
+                struct.pack_into("<Q", self.data, off + 8,
+                                 len(self.data) + 4096)
+                return True
+        return False
+
+    def point_section_past_eof(self, stype):
+        shoff, = struct.unpack_from("<Q", self.data, 40)
+        shentsize, shnum = struct.unpack_from("<HH", self.data, 58)
+        for i in range(0, shnum):
+            off = shoff + i * shentsize
+            if struct.unpack_from("<I", self.data, off + 4)[0] == stype:
+                struct.pack_into("<Q", self.data, off + 24,
+                                 len(self.data) + 4096)
+                return True
+        return False
+
+    def test_valid(self):
+        elf = ElfFile("valid", data=bytes(self.data))
+        self.assertTrue(len(elf.get_dynamic().needed) > 0)
+        undefined, exported = elf.get_dynamic_symbols()
+        self.assertTrue(len(undefined) > 0)
+
+    def test_dynamic_past_eof(self):
+        if not self.point_segment_past_eof(PT_DYNAMIC):
+            self.skipTest("No PT_DYNAMIC")
+        elf = ElfFile("corrupt", data=bytes(self.data))
+        self.assertRaises(ElfError, elf.get_dynamic)
+
+    def test_notes_past_eof(self):
+        if not self.point_segment_past_eof(PT_NOTE):
+            self.skipTest("No PT_NOTE")
+        elf = ElfFile("corrupt", data=bytes(self.data))
+        self.assertRaises(ElfError, elf.get_build_id)
+
+    def test_dynsym_past_eof(self):
+        if not self.point_section_past_eof(SHT_DYNSYM):
+            self.skipTest("No .dynsym")
+        elf = ElfFile("corrupt", data=bytes(self.data))
+        self.assertRaises(ElfError, elf.get_dynamic_symbols)
+
+    def test_truncated(self):
+        self.assertRaises(ElfError, ElfFile, "truncated",
+                          data=bytes(self.data[0:40]))
+
+
+if __name__ == "__main__":
+    unittest.main()
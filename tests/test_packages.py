@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+from ypkg2.packages import PackageGenerator, PRIORITY_USER
+from ypkg2.stringglob import StringPathGlob
+
+import fnmatch
+import os
+import random
+import unittest
+
+# Path segments to build paths and patterns from, including glob syntax
+# and empty segments, i.e. paths ending in "/"
+SEGMENTS = ["usr", "bin", "lib", "lib64", "lib32", "share", "include", "doc",
+            "qt5", "man", "man3", "debug", "cmake", "haswell", "vala-0.36",
+            "vapi", "ghc-8.0", "gtk-doc", "html", "pkgconfig", "x", "[a]",
+            "a?b", "*", ""]
+NAMES = ["libz.so", "libz.so.1", "libz.so.1.2", "libz.a", "zlib.pc",
+         "zlib.qch", "zlib.m4", "README", "x.h", "x", "[a]", "a?b",
+         "libz*.so", ""]
+PATTERNS = ["/usr/share/doc/", "/usr/lib64/lib*.so", "/usr/bin/x",
+            "/usr/*/x/", "/usr/share/*/*.h", "/usr/lib64/haswell",
+            "/usr/include/x.h", "/usr/lib*/debug/", "/usr/share/man/man3/",
+            "/[a]", "/usr/[a]/", "/usr/[a]/a?b", "/usr/*/[a]",
+            "/usr/lib32/lib*.so.*", "/", "/usr/", "/usr/share/doc/qt5/*.qch",
+            "/usr/lib?4/*", "/usr/lib64/", "/usr/lib64/lib*.so*"]
+TARGETS = ["main", "devel", "docs", "32bit", "32bit-devel"]
+
+
+class Spec:
+
+    pkg_permanent = None
+
+    def __init__(self, name, libsplit):
+        self.pkg_name = name
+        self.pkg_libsplit = libsplit
+
+
+def match(pattern, path):
+    """ Original segment by segment StringPathGlob.match """
+    if pattern.prefixMatch:
+        return pattern.pattern.endswith(os.sep) and \
+            not StringPathGlob.is_a_pattern(pattern.pattern) and \
+            path.startswith(pattern.pattern)
+    ours = pattern.pattern.split(os.sep)
+    theirs = path.split(os.sep)
+    if len(ours) > len(theirs):
+        return False
+    for our_elem, their_elem in zip(ours, theirs):
+        if our_elem == their_elem:
+            continue
+        if not StringPathGlob.is_a_pattern(our_elem) or \
+                not fnmatch.fnmatchcase(their_elem, our_elem):
+            return False
+    return True
+
+
+def get_pattern(gene, path):
+    """ Original PackageGenerator.get_pattern, testing every pattern """
+    matches = [p for p in gene.patterns if match(p, path)]
+    if len(matches) == 0:
+        return None
+    matches = sorted(matches, key=StringPathGlob.get_priority, reverse=True)
+    return matches[0]
+
+
+def emit_packages(gene):
+    """ Original PackageGenerator.emit_packages, each package giving up
+        everything captured by any other package """
+    for package in gene.packages:
+        for comparison in gene.packages:
+            if comparison == package:
+                continue
+            for file in gene.packages[comparison].emit_files():
+                gene.packages[package].exclude_file(file)
+
+
+def get_path(rand):
+    if rand.random() < 0.1:
+        return "/".join(rand.choice(SEGMENTS)
+                        for i in range(rand.randint(1, 4)))
+    segments = [rand.choice(SEGMENTS) for i in range(rand.randint(0, 4))]
+    return "/" + "/".join(["usr"] + segments + [rand.choice(NAMES)])
+
+
+def get_generator(seed):
+    """ Generator with a random set of extra patterns, ties included """
+    rand = random.Random(seed)
+    gene = PackageGenerator(Spec(rand.choice(["x", "doc", "zlib"]),
+                                 rand.random() < 0.5))
+    priorities = [0, 1, PRIORITY_USER, PRIORITY_USER + 1]
+    for pattern in rand.sample(PATTERNS, rand.randint(0, len(PATTERNS))):
+        gene.add_pattern(pattern, rand.choice(TARGETS),
+                         priority=rand.choice(priorities))
+    return gene, rand
+
+
+class GetPatternTest(unittest.TestCase):
+    """ Compiled pattern lookups must agree with testing every pattern """
+
+    def test_random(self):
+        for seed in range(30):
+            gene, rand = get_generator(seed)
+            for i in range(2000):
+                path = get_path(rand)
+                self.assertIs(gene.get_pattern(path), get_pattern(gene, path),
+                              "{} (seed {})".format(path, seed))
+
+    def test_ties(self):
+        gene = PackageGenerator(Spec("zlib", True))
+        gene.add_pattern("/usr/lib64/lib*", "docs", priority=PRIORITY_USER)
+        gene.add_pattern("/usr/lib64/", "32bit", priority=PRIORITY_USER)
+        gene.add_pattern("/usr/*/libz.so", "devel", priority=PRIORITY_USER)
+        for path in ["/usr/lib64/libz.so", "/usr/lib64/libz.a",
+                     "/usr/lib64/x", "/usr/lib64/"]:
+            ref = get_pattern(gene, path)
+            self.assertEqual(ref.pattern, "/usr/lib64/lib*"
+                             if "lib" in os.path.basename(path)
+                             else "/usr/lib64/")
+            self.assertIs(gene.get_pattern(path), ref)
+
+    def test_literal_glob(self):
+        gene = PackageGenerator(Spec("zlib", True))
+        gene.add_pattern("/usr/[a]/a?b", "docs", priority=PRIORITY_USER)
+        gene.add_pattern("/usr/share/*/", "devel", priority=PRIORITY_USER)
+        for path in ["/usr/[a]/a?b", "/usr/a/aab", "/usr/[a]/aab",
+                     "/usr/a/a?b", "/usr/share/*/", "/usr/share/x/"]:
+            self.assertIs(gene.get_pattern(path), get_pattern(gene, path),
+                          path)
+        self.assertEqual(gene.get_pattern("/usr/[a]/a?b").pattern,
+                         "/usr/[a]/a?b")
+
+    def test_trailing_separator(self):
+        gene = PackageGenerator(Spec("zlib", True))
+        gene.add_pattern("/usr/share/doc/zlib/", "docs",
+                         priority=PRIORITY_USER)
+        for path in ["/usr/share/doc/zlib/", "/usr/share/doc/zlib",
+                     "/usr/share/doc/", "/usr/include/", "/usr/lib32/",
+                     "/usr/lib64/debug/", "/"]:
+            self.assertIs(gene.get_pattern(path), get_pattern(gene, path),
+                          path)
+
+
+class EmitPackagesTest(unittest.TestCase):
+    """ Files captured by several packages go to the last one created """
+
+    def get_packages(self, seed, emit):
+        gene, rand = get_generator(seed)
+        paths = [get_path(rand) for i in range(300)]
+        for i in range(600):
+            path = rand.choice(paths)
+            roll = rand.random()
+            if roll < 0.05:
+                gene.remove_file(path)
+            elif roll < 0.1:
+                # Recapture earlier files by another package
+                gene.add_pattern(rand.choice(PATTERNS), rand.choice(TARGETS),
+                                 priority=PRIORITY_USER + i)
+            else:
+                gene.add_file(path)
+        emit(gene)
+        return dict((name, list(gene.packages[name].emit_files()))
+                    for name in gene.packages)
+
+    def test_random(self):
+        shared = 0
+        for seed in range(30):
+            ref = self.get_packages(seed, emit_packages)
+            self.assertEqual(self.get_packages(seed,
+                                               PackageGenerator.emit_packages),
+                             ref, "seed {}".format(seed))
+            shared += self.count_shared(seed)
+        # Make sure the last owner rule was actually exercised
+        self.assertGreater(shared, 0)
+
+    def count_shared(self, seed):
+        """ Paths captured by more than one package before emitting """
+        packages = self.get_packages(seed, lambda gene: None)
+        seen = set()
+        shared = 0
+        for files in packages.values():
+            shared += len(seen.intersection(files))
+            seen.update(files)
+        return shared
+
+    def test_last_owner(self):
+        gene = PackageGenerator(Spec("zlib", True))
+        gene.add_file("/usr/lib64/libz.so")
+        gene.add_pattern("/usr/lib64/libz.so", "docs", priority=PRIORITY_USER)
+        gene.add_file("/usr/lib64/libz.so")
+        gene.add_pattern("/usr/lib64/", "main", priority=PRIORITY_USER + 1)
+        gene.add_file("/usr/lib64/libz.so")
+        gene.emit_packages()
+        self.assertEqual(gene.packages["devel"].emit_files(), [])
+        self.assertEqual(gene.packages["docs"].emit_files(), [])
+        self.assertEqual(gene.packages["main"].emit_files(),
+                         ["/usr/lib64/libz.so"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -12,10 +12,21 @@
 #
 
 from . import console_ui
+from .sonameindex import SonameIndex, PkgconfigIndex, get_installdb_stamp
+from .sonameindex import DEFAULT_PKGCONFIG_INDEX_PATH
 from inary.db.installdb import InstallDB
 from inary.db.packagedb import PackageDB
 from inary.db.filesdb import FilesDB
+from collections import OrderedDict
 import os
+import sys
+import time
+
+# Entries kept per system wide resolver cache
+DEFAULT_CACHE_ENTRIES = 4096
+
+# Marks a path we've not asked the FilesDB about yet
+FileUnknown = object()
 
 # Provided historically for our pre-glvnd architecture.
 # Technically speaking this isn't required anymore, but lets just
@@ -39,75 +50,405 @@ ExceptionRules = [
 ]
 
 
-class DependencyResolver:
+# Default library search order, native and emul32
+SearchDirs = ["/usr/lib64", "/usr/lib"]
+SearchDirs32 = ["/usr/lib32", "/usr/lib", "/usr/lib64"]
 
-    idb = None
-    pdb = None
-    fdb = None
+# Kernels are found through the System.map of the main kernel package
+KernelDirs = ["/usr/lib/kernel", "/usr/lib64/kernel"]
+
+# Directories we resolve libraries and kernels from
+LibraryDirs = ["/usr/lib64", "/usr/lib", "/usr/lib32"] + KernelDirs
+
+
+class LibrarySearchModel:
+    """ Models where the dynamic linker would look for a file's libraries,
+        so candidates can be answered from the package databases without
+        looking at the host """
+
+    dirs = None
+    dirs32 = None
+
+    def __init__(self, dirs=SearchDirs, dirs32=SearchDirs32):
+        self.dirs = list(dirs)
+        self.dirs32 = list(dirs32)
+
+    def get_rpaths(self, info):
+        """ rpaths of the file, with $ORIGIN mapped to its own directory """
+        ret = list()
+        if not info.rpaths:
+            return ret
+        origin = os.path.dirname(info.pretty)
+        for rpath in sorted(info.rpaths):
+            if not rpath:
+                continue
+            rpath = rpath.replace("${ORIGIN}", origin)
+            rpath = rpath.replace("$ORIGIN", origin)
+            ret.append(os.path.normpath(rpath))
+        return ret
+
+    def get_paths(self, info):
+        """ Directories searched for the libraries this file needs """
+        paths = list(self.dirs32 if info.emul32 else self.dirs)
+        paths.extend(self.get_rpaths(info))
+        return paths
 
-    global_rpaths = set()
-    global_rpaths32 = set()
-    global_kernels = dict()
+
+class LibraryPathIndex:
+    """ Files of provider packages within the directories we actually look
+        things up in, keyed by interned directory then basename. Packages are
+        only loaded once they've been found to provide something, as there
+        is a high chance that each package depends on multiple things in a
+        single package. """
+
+    dirs = None
+    loaded = None
+
+    lookups = 0
+    hits = 0
+
+    def __init__(self):
+        self.dirs = dict()
+        self.loaded = set()
+        self.add_dirs(LibraryDirs)
+
+    def add_dirs(self, dirs):
+        """ Start indexing these directories too, i.e. rpaths """
+        added = False
+        for d in dirs:
+            d = d.rstrip("/")
+            if d and d not in self.dirs:
+                self.dirs[sys.intern(d)] = dict()
+                added = True
+        if added:
+            # Already loaded packages may have files in here
+            self.loaded.clear()
+
+    def load_package(self, idb, pkg):
+        """ Pull in the interesting files of the given package """
+        if pkg in self.loaded:
+            return
+        self.loaded.add(pkg)
+        pkg = sys.intern(pkg)
+        for file in idb.get_files(pkg).list:
+            dirn, base = os.path.split("/" + file.path)
+            if dirn in self.dirs:
+                self.dirs[dirn][base] = pkg
+
+    def lookup(self, fpath):
+        """ Owner of fpath if we've already loaded it """
+        self.lookups += 1
+        dirn, base = os.path.split(fpath)
+        if dirn not in self.dirs:
+            return None
+        pkg = self.dirs[dirn].get(base)
+        if pkg:
+            self.hits += 1
+        return pkg
+
+    def get_size(self):
+        """ Number of entries and approximate memory use in bytes """
+        count = 0
+        size = sys.getsizeof(self.dirs)
+        for dirn, files in self.dirs.items():
+            count += len(files)
+            size += sys.getsizeof(files)
+            size += sum([sys.getsizeof(x) for x in files])
+        return count, size
+
+    def emit_stats(self):
+        count, size = self.get_size()
+        rate = 0.0
+        if self.lookups > 0:
+            rate = 100.0 * self.hits / self.lookups
+        console_ui.emit_info("Dependency", "Library path index: {} files "
+                             "from {} packages in {} KiB, {} of {} lookups "
+                             "hit ({:.1f}%)".format(
+                                 count, len(self.loaded), size // 1024,
+                                 self.hits, self.lookups, rate))
+
+
+class LRUCache:
+    """ Size bounded mapping, evicting the least recently used entries """
+
+    name = None
+    maxsize = 0
+
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.items.clear()
+
+    def emit_stats(self):
+        console_ui.emit_info("Cache", "Resolver {} cache: {} entries, {} hits,"
+                             " {} misses, {} evicted".format(
+                                 self.name, len(self.items), self.hits,
+                                 self.misses, self.evictions))
+
+
+class ResolverCache:
+    """ System wide lookups against the installed packages. These stay valid
+        across builds, and may be shared by resolvers, until the InstallDB
+        itself changes. """
+
+    stamp = None
+
+    bindeps = None
+    bindeps_emul32 = None
+    kernels = None
+    files = None
+
+    # Outcome of each full FilesDB scan, and lookups nothing provides
+    scans = None
+    deadends = None
+
+    # pkgconfig name -> installed provider, loaded on first use
+    pkgconfigs = None
+    pkgconfigs32 = None
+    pkgconfig_path = None
+
+    def __init__(self, maxsize=DEFAULT_CACHE_ENTRIES,
+                 pkgconfig_path=DEFAULT_PKGCONFIG_INDEX_PATH):
+        self.pkgconfig_path = pkgconfig_path
+        self.bindeps = LRUCache("soname", maxsize)
+        self.bindeps_emul32 = LRUCache("soname (emul32)", maxsize)
+        self.kernels = LRUCache("kernel", maxsize)
+        self.files = LRUCache("path", maxsize)
+        self.scans = LRUCache("scan", maxsize)
+        self.deadends = LRUCache("dead end", maxsize)
+
+    def get_caches(self):
+        return [self.bindeps, self.bindeps_emul32, self.kernels, self.files,
+                self.scans, self.deadends]
+
+    def get_pkgconfigs(self, idb, emul32):
+        """ pkgconfig() providers of every installed package, from the on
+            disk index while it still describes the InstallDB """
+        if self.pkgconfigs is None:
+            index = PkgconfigIndex(self.pkgconfig_path)
+            if not index.load() or index.is_stale():
+                index.build(idb)
+                console_ui.emit_info("Dependency", "Indexed {} pkgconfig and "
+                                     "{} pkgconfig32 providers".format(
+                                         len(index.pkgconfigs),
+                                         len(index.pkgconfigs32)))
+                try:
+                    index.save()
+                except Exception as e:
+                    # Unprivileged builds can't write it, just rebuild
+                    console_ui.emit_info("Dependency", "Unable to save the "
+                                         "pkgconfig index: {}".format(e))
+            self.pkgconfigs = index.pkgconfigs
+            self.pkgconfigs32 = index.pkgconfigs32
+        if emul32:
+            return self.pkgconfigs32
+        return self.pkgconfigs
+
+    def validate(self):
+        """ Drop everything if the InstallDB changed since the last use """
+        try:
+            stamp = get_installdb_stamp()
+        except Exception as e:
+            stamp = None
+        if stamp is not None and stamp == self.stamp:
+            return
+        for cache in self.get_caches():
+            cache.clear()
+        self.pkgconfigs = None
+        self.pkgconfigs32 = None
+        self.stamp = stamp
+
+    def emit_stats(self):
+        for cache in self.get_caches():
+            if cache.hits + cache.misses > 0:
+                cache.emit_stats()
+
+
+class ResolverSession:
+    """ State local to the packages of a single build """
+
+    ctx = None
     gene = None
+    packageSet = None
 
-    bindeps_cache = dict()
-    bindeps_emul32 = dict()
+    global_rpaths = None
+    global_rpaths32 = None
+    global_sonames = None
+    global_sonames32 = None
+    global_pkgconfigs = None
+    global_pkgconfig32s = None
+    global_kernels = None
 
-    pkgconfig_cache = dict()
-    pkgconfig32_cache = dict()
+    lib_paths = None
 
-    files_cache = dict()
+    def __init__(self, context, gene, packageSet):
+        self.ctx = context
+        self.gene = gene
+        self.packageSet = packageSet
 
-    kernel_cache = dict()
+        self.global_rpaths = set()
+        self.global_rpaths32 = set()
+        self.global_sonames = dict()
+        self.global_sonames32 = dict()
+        self.global_pkgconfigs = dict()
+        self.global_pkgconfig32s = dict()
+        self.global_kernels = dict()
 
-    deadends = dict()
+        self.lib_paths = LibraryPathIndex()
 
-    # Cached from packagedb
-    pkgConfigs = None
-    pkgConfigs32 = None
+
+class DependencyResolver:
+
+    idb = None
+    pdb = None
+    fdb = None
+
+    # Shared, bounded system wide lookups
+    cache = None
+    # Build currently being resolved
+    session = None
+
+    # Library search model for binary dependencies
+    search = None
+    # Check candidate paths exist on the host, rather than trusting the
+    # package databases alone
+    verify_host = False
+
+    # Opt-in lookup tracing, see ResolverTrace
+    trace = None
+
+    # Prebuilt soname -> provider index, None when missing or stale
+    soname_index = None
 
     def search_file(self, fname):
         if fname[0] == '/':
             fname = fname[1:]
-        if fname in self.deadends:
-            return None
+        started = time.time()
+        ret = self.cache.files.get(fname, FileUnknown)
+        if ret is not FileUnknown:
+            self.trace_step("files-cache", fname, ret and ret[0], started)
+            return ret
+        layer = "filesdb"
         if self.fdb.has_file(fname):
-            return self.fdb.get_file(fname)
-        # Nasty file conflict crap happened on update and the filesdb
-        # is now inconsistent ..
-        ret = self.fdb.search_file(fname)
-        if len(ret) == 1:
-            return ret[0]
-        # Just blacklist further lookups here
-        self.deadends[fname] = 0
+            ret = self.fdb.get_file(fname)
+        elif not self.verify_host:
+            # Without knowing the file exists, the full scan below would
+            # run for every candidate path that isn't there.
+            ret = None
+        else:
+            # Nasty file conflict crap happened on update and the filesdb
+            # is now inconsistent ..
+            layer = "filesdb-scan"
+            ret = self.fdb.search_file(fname)
+            # Just blacklist further lookups here
+            ret = ret[0] if len(ret) == 1 else None
+        self.trace_step(layer, fname, ret and ret[0], started)
+        self.cache.files.put(fname, ret)
+        return ret
+
+    def scan_files(self, paths, name):
+        """ Last resort once nothing provides name. Nasty file conflicts on
+            update leave the filesdb inconsistent, and only a full scan will
+            find those files, which is far too slow to do for every candidate
+            path up front. """
+        for path in paths:
+            fname = os.path.join(path, name)[1:]
+            started = time.time()
+            ret = self.cache.scans.get(fname, FileUnknown)
+            if ret is not FileUnknown:
+                self.trace_step("scan-cache", fname, ret and ret[0], started)
+            else:
+                ret = self.fdb.search_file(fname)
+                ret = ret[0] if len(ret) == 1 else None
+                self.trace_step("filesdb-scan", fname, ret and ret[0],
+                                started)
+                self.cache.scans.put(fname, ret)
+            if ret:
+                return ret
         return None
 
-    def __init__(self):
+    def is_deadend(self, key):
+        """ Nothing installed provided this lookup last time around """
+        started = time.time()
+        if self.cache.deadends.get(key) is None:
+            return False
+        self.trace_step("dead-end", None, None, started)
+        return True
+
+    def trace_step(self, layer, path, result, started):
+        """ Record a lookup step when tracing """
+        if self.trace:
+            self.trace.step(layer, path, result, started)
+
+    def load_provider(self, lpkg):
+        """ Pull the provider's library paths into the session index """
+        started = time.time()
+        self.session.lib_paths.load_package(self.idb, lpkg)
+        self.trace_step("get_files", None, lpkg, started)
+
+    def __init__(self, cache=None, search=None, verify_host=False):
         """ Allows us to do look ups on all packages """
         self.idb = InstallDB()
         self.pdb = PackageDB()
         self.fdb = FilesDB()
-
+        if search is None:
+            search = LibrarySearchModel()
+        self.search = search
+        self.verify_host = verify_host
+        if cache is None:
+            cache = ResolverCache()
+        self.cache = cache
+
+        index = SonameIndex()
+        if index.load() and not index.is_stale():
+            self.soname_index = index
+        else:
+            index.close()
+            console_ui.emit_info("Dependency", "Soname index unavailable, "
+                                 "falling back to the files database")
 
     def get_symbol_provider(self, info, symbol):
         """ Grab the symbol from the local packages """
+        session = self.session
         if info.emul32:
-            tgtMap = self.global_sonames32
-            rPaths = self.global_rpaths32
+            tgtMap = session.global_sonames32
+            rPaths = session.global_rpaths32
         else:
-            tgtMap = self.global_sonames
-            rPaths = self.global_rpaths
+            tgtMap = session.global_sonames
+            rPaths = session.global_rpaths
 
         if symbol in tgtMap:
             pkgname = tgtMap[symbol]
-            return self.ctx.spec.get_package_name(pkgname)
+            return session.ctx.spec.get_package_name(pkgname)
 
         # Check if its in any rpath
         for rpath in rPaths:
             fpath = os.path.join(rpath, symbol)
-            pkg = self.gene.get_file_owner(fpath)
+            pkg = session.gene.get_file_owner(fpath)
             if pkg:
-                return self.ctx.spec.get_package_name(pkg.name)
+                return session.ctx.spec.get_package_name(pkg.name)
         return None
 
     def get_symbol_external(self, info, symbol, paths=None):
@@ -115,165 +456,368 @@ class DependencyResolver:
             i.e. installed binary dependencies
         """
         # Try a cached approach first.
-        if info.emul32:
-            if symbol in self.bindeps_emul32:
-                return self.bindeps_emul32[symbol]
-        else:
-            if symbol in self.bindeps_cache:
-                return self.bindeps_cache[symbol]
+        started = time.time()
+        bindeps = self.get_bindeps_cache(info)
+        lpkg = bindeps.get(symbol)
+        if lpkg:
+            self.trace_step("soname-cache", None, lpkg, started)
+            return lpkg
 
         if symbol in ExceptionRules:
             if info.emul32:
-                return "libglvnd-32bit"
+                lpkg = "libglvnd-32bit"
             else:
-                return "libglvnd"
+                lpkg = "libglvnd"
+            self.trace_step("exception", None, lpkg, started)
+            return lpkg
 
         if not paths:
-            paths = ["/usr/lib64", "/usr/lib"]
-            if info.emul32:
-                paths = ["/usr/lib32", "/usr/lib", "/usr/lib64"]
+            paths = self.search.get_paths(info)
+        deadend = ("symbol", info.emul32, symbol, tuple(paths))
+        if self.is_deadend(deadend):
+            return None
 
-            if info.rpaths:
-                paths.extend(info.rpaths)
+        lpkg = self.get_symbol_indexed(info, symbol, paths)
+        if lpkg:
+            return lpkg
 
         pkg = None
         for path in paths:
             fpath = os.path.join(path, symbol)
-            if not os.path.exists(fpath):
-                continue
-            lpkg = None
-            if fpath in self.files_cache:
-                lpkg = self.files_cache[fpath]
+            if self.verify_host:
+                started = time.time()
+                exists = os.path.exists(fpath)
+                self.trace_step("host-stat", fpath, exists, started)
+                if not exists:
+                    continue
+            started = time.time()
+            lpkg = self.session.lib_paths.lookup(fpath)
+            if lpkg:
+                self.trace_step("lib-paths", fpath, lpkg, started)
             else:
                 pkg = self.search_file(fpath)
                 if pkg:
                     lpkg = pkg[0]
             if lpkg:
-                if info.emul32:
-                    self.bindeps_emul32[symbol] = lpkg
-                else:
-                    self.bindeps_cache[symbol] = lpkg
-                console_ui.emit_info("Dependency",
-                                     "{} adds dependency on {} from {}".
-                                     format(info.pretty, symbol, lpkg))
-
-                # Populate a global files cache, basically there is a high
-                # chance that each package depends on multiple things in a
-                # single package.
-                for file in self.idb.get_files(lpkg).list:
-                    self.files_cache["/" + file.path] = lpkg
-                return lpkg
+                return self.add_symbol_provider(info, symbol, lpkg)
+
+        # Host checks already ran the scan for every existing path
+        if not self.verify_host:
+            pkg = self.scan_files(paths, symbol)
+            if pkg:
+                return self.add_symbol_provider(info, symbol, pkg[0])
+        self.cache.deadends.put(deadend, True)
         return None
 
-    def handle_binary_deps(self, packageName, info):
-        """ Handle direct binary dependencies """
-        pkgName = self.ctx.spec.get_package_name(packageName)
+    def add_symbol_provider(self, info, symbol, lpkg):
+        """ Remember an external provider found for symbol """
+        self.get_bindeps_cache(info).put(symbol, lpkg)
+        console_ui.emit_info("Dependency", "{} adds dependency on {} from {}".
+                             format(info.pretty, symbol, lpkg))
+        self.load_provider(lpkg)
+        return lpkg
+
+    def get_bindeps_cache(self, info):
+        """ soname -> provider cache for the file's architecture """
+        if info.emul32:
+            return self.cache.bindeps_emul32
+        return self.cache.bindeps
+
+    def get_symbol_indexed(self, info, symbol, paths):
+        """ Look the symbol up in the soname index, if we have one """
+        if not self.soname_index:
+            return None
+        started = time.time()
+        for path in paths:
+            fpath = os.path.join(path, symbol)
+            lpkg = self.soname_index.lookup(fpath, info.emul32)
+            if not lpkg:
+                continue
+            self.trace_step("soname-index", fpath, lpkg, started)
+            self.get_bindeps_cache(info).put(symbol, lpkg)
+            console_ui.emit_info("Dependency",
+                                 "{} adds dependency on {} from {}".
+                                 format(info.pretty, symbol, lpkg))
+            return lpkg
+        self.trace_step("soname-index", None, None, started)
+        return None
 
-        for sym in info.symbol_deps:
-            r = self.get_symbol_provider(info, sym)
+    def resolve_symbol(self, key):
+        """ Find the provider for a unique (symbol, emul32, rpaths) key """
+        symbol, emul32, rpaths, info = key
+        if self.trace:
+            self.trace.begin("symbol", symbol, info.pretty)
+        started = time.time()
+        r = self.get_symbol_provider(info, symbol)
+        self.trace_step("local", None, r, started)
+        if not r:
+            r = self.get_symbol_external(info, symbol)
+        if self.trace:
+            self.trace.end(r)
+        return r
+
+    def collect_symbols(self, packageSet):
+        """ Map every unique (symbol, emul32, rpaths) lookup to the files
+            needing it, returning those and the total lookup count """
+        lookups = OrderedDict()
+        total = 0
+        for packageName in packageSet:
+            for info in packageSet[packageName]:
+                if not info.symbol_deps:
+                    continue
+                # Expanded, as $ORIGIN differs between files
+                rpaths = tuple(self.search.get_rpaths(info))
+                for sym in info.symbol_deps:
+                    total += 1
+                    key = (sym, info.emul32, rpaths)
+                    if key not in lookups:
+                        lookups[key] = list()
+                    lookups[key].append((packageName, info))
+        return lookups, total
+
+    def handle_binary_deps(self, packageSet):
+        """ Handle direct binary dependencies. Each unique lookup is only
+            resolved once, then the results are applied to every package
+            needing them. """
+        session = self.session
+        lookups, total = self.collect_symbols(packageSet)
+        if len(lookups) == 0:
+            return
+
+        for key in lookups:
+            # Carry the first requesting file along for emul32/rpaths and logs
+            r = self.resolve_symbol(key + (lookups[key][0][1],))
             if not r:
-                r = self.get_symbol_external(info, sym)
-                if not r:
-                    print("Fatal: Unknown symbol: {}".format(sym))
+                print("Fatal: Unknown symbol: {}".format(key[0]))
+                continue
+            for packageName, info in lookups[key]:
+                pkgName = session.ctx.spec.get_package_name(packageName)
+                # Don't self depend
+                if pkgName == r:
                     continue
+                session.gene.packages[packageName].depend_packages.add(r)
+
+        console_ui.emit_info("Dependency", "Resolved {} unique binary "
+                             "dependencies for {} lookups".format(
+                                 len(lookups), total))
+
+    def get_pkgconfig_provider(self, info, name):
+        """ Get a local pkgconfig provider for the given name """
+        session = self.session
+        maps = [session.global_pkgconfigs]
+        if info.emul32:
+            maps.insert(0, session.global_pkgconfig32s)
+        for tgtMap in maps:
+            if name in tgtMap:
+                return session.ctx.spec.get_package_name(tgtMap[name])
+        return None
+
+    def get_pkgconfig_external(self, info, name):
+        """ Get the installed provider of a pkgconfig name. emul32 files may
+            also depend on arch independent providers, i.e. /usr/share """
+        emuls = [False]
+        if info.emul32:
+            emuls.insert(0, True)
+        for emul32 in emuls:
+            providers = self.cache.get_pkgconfigs(self.idb, emul32)
+            if name in providers:
+                return providers[name]
+        return None
+
+    def handle_pkgconfig_deps(self, packageName, info):
+        """ Handle pkgconfig dependencies """
+        session = self.session
+        pkgName = session.ctx.spec.get_package_name(packageName)
+        tgtPkg = session.gene.packages[packageName]
+
+        for item in sorted(info.pkgconfig_deps):
+            if self.trace:
+                self.trace.begin("pkgconfig", item, info.pretty)
+            started = time.time()
+            prov = self.get_pkgconfig_provider(info, item)
+            self.trace_step("local", None, prov, started)
+            if not prov:
+                started = time.time()
+                prov = self.get_pkgconfig_external(info, item)
+                self.trace_step("pkgconfig-index", None, prov, started)
+            if self.trace:
+                self.trace.end(prov)
+            if not prov:
+                console_ui.emit_warning("PKGCONFIG", "Not adding unknown"
+                                        " dependency {} to {}".
+                                        format(item, pkgName))
+                continue
             # Don't self depend
-            if pkgName == r:
+            if pkgName == prov or prov in tgtPkg.depend_packages:
+                continue
+            tgtPkg.depend_packages.add(prov)
+            console_ui.emit_info("PKGCONFIG", "{} adds dependency on {}".
+                                 format(pkgName, prov))
+
+    def handle_soname_links(self, packageName, info):
+        """ Add dependencies between packages due to a .so splitting, i.e.
+            zlib-devel depending on zlib for the libz.so.1 its link needs """
+        session = self.session
+        ourName = session.ctx.spec.get_package_name(packageName)
+        tgtPkg = session.gene.packages[packageName]
+
+        for link in sorted(info.soname_links):
+            owner = session.gene.get_file_owner(link)
+            if not owner:
+                console_ui.emit_warning("SOLINK", "{} depends on non existing"
+                                        " soname link: {}".format(
+                                            packageName, link))
                 continue
-            self.gene.packages[packageName].depend_packages.add(r)
+            pkgName = session.ctx.spec.get_package_name(owner.name)
+            # Don't self depend
+            if pkgName == ourName or pkgName in tgtPkg.depend_packages:
+                continue
+            tgtPkg.depend_packages.add(pkgName)
+            console_ui.emit_info("SOLINK", "{} adds dependency on {}".
+                                 format(ourName, pkgName))
 
     def get_kernel_provider(self, info, version):
         """ i.e. self dependency situation """
-        if version in self.global_kernels:
-            pkg = self.global_kernels[version]
-            return self.ctx.spec.get_package_name(pkg)
+        session = self.session
+        if version in session.global_kernels:
+            pkg = session.global_kernels[version]
+            return session.ctx.spec.get_package_name(pkg)
         return None
 
     def get_kernel_external(self, info, version):
         """ Try to find the owning kernel for a version """
-        if version in self.kernel_cache:
-            return self.kernel_cache[version]
-
-        paths = [
-            "/usr/lib/kernel",
-            "/usr/lib64/kernel"
-        ]
+        started = time.time()
+        lpkg = self.cache.kernels.get(version)
+        if lpkg:
+            self.trace_step("kernel-cache", None, lpkg, started)
+            return lpkg
+        deadend = ("kernel", version)
+        if self.is_deadend(deadend):
+            return None
 
         pkg = None
-        for path in paths:
+        for path in KernelDirs:
             # Special file in the main kernel package
             fpath = "{}/System.map-{}".format(path, version)
-            if not os.path.exists(fpath):
-                continue
-            lpkg = None
-            if fpath in self.files_cache:
-                lpkg = self.files_cache[fpath]
+            if self.verify_host:
+                started = time.time()
+                exists = os.path.exists(fpath)
+                self.trace_step("host-stat", fpath, exists, started)
+                if not exists:
+                    continue
+            started = time.time()
+            lpkg = self.session.lib_paths.lookup(fpath)
+            if lpkg:
+                self.trace_step("lib-paths", fpath, lpkg, started)
             else:
                 pkg = self.search_file(fpath)
                 if pkg:
                     lpkg = pkg[0]
             if lpkg:
-                self.kernel_cache[version] = lpkg
-                console_ui.emit_info("Kernel",
-                                     "{} adds module dependency on {} from {}".
-                                     format(info.pretty, version, lpkg))
-
-                # Populate a global files cache, basically there is a high
-                # chance that each package depends on multiple things in a
-                # single package.
-                for file in self.idb.get_files(lpkg).list:
-                    self.files_cache["/" + file.path] = lpkg
-                return lpkg
+                return self.add_kernel_provider(info, version, lpkg)
+
+        # Host checks already ran the scan for every existing path
+        if not self.verify_host:
+            pkg = self.scan_files(KernelDirs, "System.map-{}".format(version))
+            if pkg:
+                return self.add_kernel_provider(info, version, pkg[0])
+        self.cache.deadends.put(deadend, True)
         return None
 
+    def add_kernel_provider(self, info, version, lpkg):
+        """ Remember an external provider found for a kernel version """
+        self.cache.kernels.put(version, lpkg)
+        console_ui.emit_info("Kernel", "{} adds module dependency on {} "
+                             "from {}".format(info.pretty, version, lpkg))
+        self.load_provider(lpkg)
+        return lpkg
+
     def handle_kernel_deps(self, packageName, info):
         """ Add dependency between packages due to kernel version """
-        pkgName = self.ctx.spec.get_package_name(packageName)
+        pkgName = self.session.ctx.spec.get_package_name(packageName)
 
+        if self.trace:
+            self.trace.begin("kernel", info.dep_kernel, info.pretty)
+        started = time.time()
         r = self.get_kernel_provider(info, info.dep_kernel)
+        self.trace_step("local", None, r, started)
         if not r:
             r = self.get_kernel_external(info, info.dep_kernel)
-            if not r:
-                print("Fatal: Unknown kernel: {}".format(sym))
-                return
+        if self.trace:
+            self.trace.end(r)
+        if not r:
+            print("Fatal: Unknown kernel: {}".format(info.dep_kernel))
+            return
         # Don't self depend
         if pkgName == r:
             return
-        self.gene.packages[packageName].depend_packages.add(r)
+        self.session.gene.packages[packageName].depend_packages.add(r)
+
+    def begin_session(self, context, gene, packageSet):
+        """ Start resolving a new build """
+        self.cache.validate()
+        if self.soname_index and self.soname_index.is_stale():
+            self.soname_index.close()
+            self.soname_index = None
+        self.session = ResolverSession(context, gene, packageSet)
+
+    def end_session(self):
+        """ Drop everything local to the current build """
+        self.session.lib_paths.emit_stats()
+        self.cache.emit_stats()
+        self.session = None
 
     def compute_for_packages(self, context, gene, packageSet):
         """ packageSet is a dict mapping here. """
-        self.gene = gene
-        self.packageSet = packageSet
-        self.ctx = context
+        self.begin_session(context, gene, packageSet)
+        try:
+            self.collect_globals(packageSet)
+            self.resolve_packages(packageSet)
+        finally:
+            self.end_session()
+        return True
 
-        # First iteration, collect the globals
+    def collect_globals(self, packageSet):
+        """ First iteration, collect the globals """
+        session = self.session
         for packageName in packageSet:
             for info in packageSet[packageName]:
                 if info.rpaths:
+                    session.lib_paths.add_dirs(self.search.get_rpaths(info))
                     if info.emul32:
-                        self.global_rpaths32.update(info.rpaths)
+                        session.global_rpaths32.update(info.rpaths)
                     else:
-                        self.global_rpaths.update(info.rpaths)
+                        session.global_rpaths.update(info.rpaths)
                 if info.soname:
                     if info.emul32:
-                        self.global_sonames32[info.soname] = packageName
+                        session.global_sonames32[info.soname] = packageName
                     else:
-                        self.global_sonames[info.soname] = packageName
+                        session.global_sonames[info.soname] = packageName
                 if info.pkgconfig_name:
                     pcName = info.pkgconfig_name
+                    provides = session.gene.packages[packageName]. \
+                        provided_symbols
+                    if info.emul32:
+                        session.global_pkgconfig32s[pcName] = packageName
+                        provides.add("pkgconfig32({})".format(pcName))
+                    else:
+                        session.global_pkgconfigs[pcName] = packageName
+                        provides.add("pkgconfig({})".format(pcName))
 
                 if info.prov_kernel:
-                    self.global_kernels[info.prov_kernel] = packageName
+                    session.global_kernels[info.prov_kernel] = packageName
+
+    def resolve_packages(self, packageSet):
+        """ Ok now find the dependencies """
+        self.handle_binary_deps(packageSet)
 
-        # Ok now find the dependencies
         for packageName in packageSet:
             for info in packageSet[packageName]:
-                if info.symbol_deps:
-                    self.handle_binary_deps(packageName, info)
+                if info.pkgconfig_deps:
+                    self.handle_pkgconfig_deps(packageName, info)
 
                 if info.soname_links:
                     self.handle_soname_links(packageName, info)
 
                 if info.dep_kernel:
                     self.handle_kernel_deps(packageName, info)
-        return True
@@ -0,0 +1,140 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+from . import console_ui
+
+import csv
+import json
+import time
+
+# Slowest lookups listed in the summary
+DEFAULT_TRACE_TOP = 10
+
+
+class TraceLookup:
+    """ A single dependency lookup and every step taken to answer it """
+
+    kind = None
+    name = None
+    file = None
+    result = None
+    layer = None
+    started = 0
+    seconds = 0
+
+    steps = None
+
+    def __init__(self, kind, name, file):
+        self.kind = kind
+        self.name = name
+        self.file = file
+        self.steps = list()
+        self.started = time.time()
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "name": self.name,
+            "file": self.file,
+            "result": self.result,
+            "layer": self.layer,
+            "seconds": self.seconds,
+            "steps": [{"layer": layer, "path": path, "result": result,
+                       "seconds": seconds}
+                      for layer, path, result, seconds in self.steps],
+        }
+
+
+class ResolverTrace:
+    """ Records how each dependency lookup was answered, and how long it
+        took, to find out where resolution time goes """
+
+    path = None
+    top = DEFAULT_TRACE_TOP
+    lookups = None
+
+    # Lookup currently being traced
+    lookup = None
+
+    def __init__(self, path, top=DEFAULT_TRACE_TOP):
+        self.path = path
+        self.top = top
+        self.lookups = list()
+
+    def begin(self, kind, name, file):
+        """ Start tracing a lookup """
+        self.lookup = TraceLookup(kind, name, file)
+
+    def step(self, layer, path, result, started):
+        """ Record one step of the current lookup, started at started """
+        lookup = self.lookup
+        if lookup is None:
+            return
+        lookup.steps.append((layer, path, result, time.time() - started))
+        # First layer to come up with an answer
+        if result and lookup.layer is None:
+            lookup.layer = layer
+
+    def end(self, result):
+        """ Finish the current lookup """
+        lookup = self.lookup
+        if lookup is None:
+            return
+        self.lookup = None
+        lookup.result = result
+        lookup.seconds = time.time() - lookup.started
+        self.lookups.append(lookup)
+
+    def write_json(self, out):
+        json.dump([x.to_dict() for x in self.lookups], out, indent=1)
+
+    def write_csv(self, out):
+        """ One row per step, repeating the lookup it belongs to """
+        writer = csv.writer(out)
+        writer.writerow(["kind", "name", "file", "result", "layer",
+                         "seconds", "step_layer", "step_path",
+                         "step_result", "step_seconds"])
+        for x in self.lookups:
+            row = [x.kind, x.name, x.file, x.result, x.layer, x.seconds]
+            if len(x.steps) == 0:
+                writer.writerow(row + ["", "", "", ""])
+            for step in x.steps:
+                writer.writerow(row + list(step))
+
+    def write(self):
+        """ Write the report, as CSV if the path asks for it """
+        with open(self.path, "w") as out:
+            if self.path.endswith(".csv"):
+                self.write_csv(out)
+            else:
+                self.write_json(out)
+
+    def emit_summary(self):
+        """ Time spent per layer, and the slowest lookups """
+        layers = dict()
+        for lookup in self.lookups:
+            for layer, path, result, seconds in lookup.steps:
+                count, total = layers.get(layer, (0, 0))
+                layers[layer] = (count + 1, total + seconds)
+        for layer in sorted(layers, key=lambda x: layers[x][1],
+                            reverse=True):
+            count, total = layers[layer]
+            console_ui.emit_info("Trace", "{}: {} calls, {:.3f}s".format(
+                                 layer, count, total))
+
+        slowest = sorted(self.lookups, key=lambda x: x.seconds,
+                         reverse=True)
+        for lookup in slowest[0:self.top]:
+            console_ui.emit_info("Trace", "{:.3f}s {} {} for {} ({})".format(
+                                 lookup.seconds, lookup.kind, lookup.name,
+                                 lookup.file, lookup.layer or "unresolved"))
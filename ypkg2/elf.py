@@ -0,0 +1,387 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+import mmap
+import os
+import struct
+
+ELF_MAGIC = b"\x7fELF"
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+
+# Program header types
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_NOTE = 4
+
+# Section header types
+SHT_DYNAMIC = 6
+SHT_NOTE = 7
+SHT_DYNSYM = 11
+
+# Symbol bindings, types and visibility
+SHN_UNDEF = 0
+STB_GLOBAL = 1
+STB_WEAK = 2
+STB_GNU_UNIQUE = 10
+STT_SECTION = 3
+STT_FILE = 4
+STV_DEFAULT = 0
+STV_PROTECTED = 3
+
+# Dynamic tags
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# Note types
+NT_GNU_BUILD_ID = 3
+
+note_header = struct.Struct("<III")
+
+
+class ElfError(Exception):
+    """ Raised when a file cannot be handled by the in-process reader """
+    pass
+
+
+class ElfLayout:
+    """ struct formats for one ELF class, little endian only """
+
+    def __init__(self, elfclass):
+        if elfclass == ELFCLASS64:
+            self.ehdr = struct.Struct("<HHIQQQIHHHHHH")
+            self.phdr = struct.Struct("<IIQQQQQQ")
+            self.shdr = struct.Struct("<IIQQQQIIQQ")
+            self.dyn = struct.Struct("<qQ")
+            # name, info, other, shndx, value, size
+            self.sym = struct.Struct("<IBBHQQ")
+        else:
+            self.ehdr = struct.Struct("<HHIIIIIHHHHHH")
+            self.phdr = struct.Struct("<IIIIIIII")
+            self.shdr = struct.Struct("<IIIIIIIIII")
+            self.dyn = struct.Struct("<iI")
+            # name, value, size, info, other, shndx
+            self.sym = struct.Struct("<IIIBBH")
+
+
+class ElfSegment:
+
+    type = None
+    offset = None
+    vaddr = None
+    filesz = None
+    align = None
+
+
+class ElfSection:
+
+    name = None
+    type = None
+    offset = None
+    size = None
+    link = None
+    align = None
+
+
+class ElfDynamic:
+    """ Interesting bits of the dynamic section """
+
+    needed = None
+    rpaths = None
+    soname = None
+
+    def __init__(self):
+        self.needed = list()
+        self.rpaths = list()
+
+
+class ElfFile:
+    """ Minimal reader for little endian ELF32/ELF64 objects, allowing us to
+        grab the bits we care about without spawning readelf et al. The file
+        is mapped read-only, so only the pages we touch are ever read. """
+
+    path = None
+    elfclass = None
+    etype = None
+    data = None
+
+    segments = None
+    sections = None
+
+    def __init__(self, path=None, data=None):
+        self.path = path
+        self.fd = None
+        self.map = None
+
+        if data is None:
+            try:
+                self.fd = os.open(path, os.O_RDONLY)
+                self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            except Exception as e:
+                self.close()
+                raise ElfError("Cannot map {}: {}".format(path, e))
+            data = self.map
+        self.data = data
+
+        try:
+            self.parse_header()
+        except ElfError:
+            self.close()
+            raise
+        except Exception as e:
+            self.close()
+            raise ElfError("Malformed ELF object {}: {}".format(path, e))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.data = None
+
+    def parse_header(self):
+        """ Validate the identity and load the program/section headers """
+        ident = self.data[0:16]
+        if len(ident) < 16 or ident[0:4] != ELF_MAGIC:
+            raise ElfError("Not an ELF object: {}".format(self.path))
+        if ident[5] != ELFDATA2LSB:
+            raise ElfError("Unsupported ELF byte order: {}".format(self.path))
+        if ident[4] not in (ELFCLASS32, ELFCLASS64):
+            raise ElfError("Unsupported ELF class: {}".format(self.path))
+
+        self.elfclass = ident[4]
+        self.layout = ElfLayout(self.elfclass)
+
+        (self.etype, machine, version, entry, phoff, shoff, flags, ehsize,
+         phentsize, phnum, shentsize, shnum, shstrndx) = \
+            self.layout.ehdr.unpack_from(self.data, 16)
+
+        self.segments = list()
+        for i in range(0, phnum):
+            self.segments.append(self.read_segment(phoff + i * phentsize))
+
+        self.sections = list()
+        for i in range(0, shnum):
+            self.sections.append(self.read_section(shoff + i * shentsize))
+
+        if 0 < shstrndx < len(self.sections):
+            names = self.sections[shstrndx]
+            for section in self.sections:
+                section.name = self.get_string(names.offset, section.name,
+                                               names.size)
+
+    def read_segment(self, offset):
+        seg = ElfSegment()
+        fields = self.layout.phdr.unpack_from(self.data, offset)
+        if self.elfclass == ELFCLASS64:
+            seg.type, flags, seg.offset, seg.vaddr, paddr, seg.filesz, \
+                memsz, seg.align = fields
+        else:
+            seg.type, seg.offset, seg.vaddr, paddr, seg.filesz, memsz, \
+                flags, seg.align = fields
+        return seg
+
+    def read_section(self, offset):
+        sec = ElfSection()
+        fields = self.layout.shdr.unpack_from(self.data, offset)
+        sec.name, sec.type = fields[0], fields[1]
+        sec.offset, sec.size, sec.link = fields[4], fields[5], fields[6]
+        sec.align = fields[8]
+        return sec
+
+    def check_range(self, offset, size):
+        """ Ensure an area named by the headers lies within the file, as the
+            accessors must only ever fail with an ElfError """
+        if offset < 0 or size < 0 or offset + size > len(self.data):
+            raise ElfError("Truncated or corrupt ELF object {}".
+                           format(self.path))
+
+    def get_string(self, base, index, limit=None):
+        """ Pull a NUL terminated string out of a string table """
+        start = base + index
+        end = self.data.find(b"\0", start)
+        if end < 0 or (limit is not None and end > base + limit):
+            raise ElfError("Corrupt string table in {}".format(self.path))
+        return self.data[start:end].decode("utf-8", "surrogateescape")
+
+    def get_section(self, name):
+        """ Return the named section, if it exists """
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+    def get_section_data(self, name):
+        """ Return the raw contents of the named section, if it exists """
+        section = self.get_section(name)
+        if section is None:
+            return None
+        self.check_range(section.offset, section.size)
+        return bytes(self.data[section.offset:section.offset + section.size])
+
+    def vaddr_to_offset(self, vaddr):
+        """ Map a virtual address into the file via the PT_LOAD segments """
+        for seg in self.segments:
+            if seg.type != PT_LOAD:
+                continue
+            if seg.vaddr <= vaddr < seg.vaddr + seg.filesz:
+                return vaddr - seg.vaddr + seg.offset
+        return None
+
+    def find_dynamic(self):
+        """ Locate the dynamic array and its string table """
+        for seg in self.segments:
+            if seg.type == PT_DYNAMIC:
+                return seg.offset, seg.filesz, None
+
+        # No program headers, i.e. relocatable objects. Use .dynamic and
+        # its linked string table instead.
+        for section in self.sections:
+            if section.type != SHT_DYNAMIC:
+                continue
+            strtab = None
+            if 0 < section.link < len(self.sections):
+                strtab = self.sections[section.link].offset
+            return section.offset, section.size, strtab
+        return None, None, None
+
+    def get_dynamic(self):
+        """ Read DT_NEEDED, DT_RPATH, DT_RUNPATH and DT_SONAME """
+        ret = ElfDynamic()
+        offset, size, strtab = self.find_dynamic()
+        if offset is None:
+            return ret
+        self.check_range(offset, size)
+
+        entries = list()
+        strsz = None
+        dyn = self.layout.dyn
+        for pos in range(offset, offset + size - dyn.size + 1, dyn.size):
+            tag, val = dyn.unpack_from(self.data, pos)
+            if tag == DT_NULL:
+                break
+            if tag == DT_STRTAB and strtab is None:
+                strtab = self.vaddr_to_offset(val)
+            elif tag == DT_STRSZ:
+                strsz = val
+            elif tag in (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH):
+                entries.append((tag, val))
+
+        if len(entries) == 0:
+            return ret
+        if strtab is None:
+            # Fall back to the .dynstr section itself
+            dynstr = self.get_section(".dynstr")
+            if dynstr is None:
+                raise ElfError("No dynamic string table in {}".
+                               format(self.path))
+            strtab = dynstr.offset
+            strsz = dynstr.size
+
+        for tag, val in entries:
+            string = self.get_string(strtab, val, strsz)
+            if tag == DT_NEEDED:
+                ret.needed.append(string)
+            elif tag == DT_SONAME:
+                ret.soname = string
+            else:
+                ret.rpaths.extend(string.split(":"))
+        return ret
+
+    def get_dynamic_symbols(self):
+        """ Return the names of the undefined and exported symbols within
+            the dynamic symbol table, ignoring symbol versions """
+        symtab = None
+        for section in self.sections:
+            if section.type == SHT_DYNSYM:
+                symtab = section
+                break
+        if symtab is None:
+            raise ElfError("No dynamic symbol table in {}".format(self.path))
+        if not 0 < symtab.link < len(self.sections):
+            raise ElfError("Corrupt dynamic symbol table in {}".
+                           format(self.path))
+        strtab = self.sections[symtab.link]
+        self.check_range(symtab.offset, symtab.size)
+        self.check_range(strtab.offset, strtab.size)
+
+        undefined = set()
+        exported = set()
+        sym = self.layout.sym
+        # First entry is always the null symbol
+        for i in range(1, symtab.size // sym.size):
+            fields = sym.unpack_from(self.data, symtab.offset + i * sym.size)
+            if self.elfclass == ELFCLASS64:
+                name, info, other, shndx = fields[0:4]
+            else:
+                name, info, other, shndx = fields[0], fields[3], fields[4], \
+                    fields[5]
+            if name == 0:
+                continue
+            if info >> 4 not in (STB_GLOBAL, STB_WEAK, STB_GNU_UNIQUE):
+                continue
+            if shndx == SHN_UNDEF:
+                undefined.add(self.get_string(strtab.offset, name,
+                                              strtab.size))
+            elif info & 0xf not in (STT_SECTION, STT_FILE) and \
+                    other & 0x3 in (STV_DEFAULT, STV_PROTECTED):
+                exported.add(self.get_string(strtab.offset, name,
+                                             strtab.size))
+        return undefined, exported
+
+    def get_notes(self, offset, size, align):
+        """ Yield (name, type, desc) for each note in the given area """
+        if align != 8:
+            align = 4
+        self.check_range(offset, size)
+        pos = offset
+        end = offset + size
+        while pos + note_header.size <= end:
+            namesz, descsz, ntype = note_header.unpack_from(self.data, pos)
+            pos += note_header.size
+            name = bytes(self.data[pos:pos + namesz]).rstrip(b"\0")
+            pos += (namesz + align - 1) & ~(align - 1)
+            desc = self.data[pos:pos + descsz]
+            pos += (descsz + align - 1) & ~(align - 1)
+            if pos > end:
+                break
+            yield name, ntype, desc
+
+    def get_build_id(self):
+        """ Return the NT_GNU_BUILD_ID as a hex string, if we have one """
+        areas = [(s.offset, s.filesz, s.align) for s in self.segments
+                 if s.type == PT_NOTE]
+        if len(areas) == 0:
+            # Relocatables (i.e. kernel modules) only have sections
+            areas = [(s.offset, s.size, s.align) for s in self.sections
+                     if s.type == SHT_NOTE]
+        for offset, size, align in areas:
+            for name, ntype, desc in self.get_notes(offset, size, align):
+                if name == b"GNU" and ntype == NT_GNU_BUILD_ID:
+                    return bytes(desc).hex()
+        return None
@@ -15,23 +15,128 @@ from . import console_ui
 from .metadata import readlink
 from . import remove_prefix
 from . import EMUL32PC
+from .elf import ElfFile, ElfError
+from .examinecache import REPORT_FIELDS, replace_file, hash_file
+from .overlink import find_unused_libraries
 import magic
+import gzip
+import lzma
 import re
 import os
 import subprocess
 import shutil
 import multiprocessing
+import copy
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 global share_ctx
+global share_cache
+global eu_strip
+global worker_magic
+
+share_cache = None
+eu_strip = None
+worker_magic = None
 
 
 v_dyn = re.compile(r"ELF (64|32)\-bit LSB shared object,")
 v_bin = re.compile(r"ELF (64|32)\-bit LSB executable,")
 v_rel = re.compile(r"ELF (64|32)\-bit LSB relocatable,")
 shared_lib = re.compile(r".*Shared library: \[(.*)\].*")
-r_path = re.compile(r".*Library rpath: \[(.*)\].*")
+r_path = re.compile(r".*Library (?:rpath|runpath): \[(.*)\].*")
 r_soname = re.compile(r".*Library soname: \[(.*)\].*")
 
+# pkg-config file syntax
+pc_variable = re.compile(r"^([A-Za-z0-9_.]+)\s*=\s*(.*)$")
+pc_keyword = re.compile(r"^([A-Za-z0-9_.]+)\s*:\s*(.*)$")
+pc_expand = re.compile(r"\$\{([A-Za-z0-9_.]*)\}")
+pc_operator = re.compile(r"(<=|>=|!=|<|>|=)")
+
+# Upper bounds on the files (and their total path length) given to a
+# single strip run
+MAX_STRIP_BATCH = 256
+MAX_STRIP_ARGS = 65536
+
+# Flags per strip mode. objcopy strips nothing unless asked to, and
+# eu-strip always moves the (full) debug info into the -f file.
+strip_flags = {
+    "shared": ["--strip-unneeded"],
+    "ko": ["-g", "--strip-unneeded"],
+    "ar": ["--strip-debug"],
+}
+objcopy_strip_flags = {
+    "shared": ["--strip-unneeded"],
+    "executable": ["--strip-all"],
+    "ko": ["-g", "--strip-unneeded"],
+    "ar": ["--strip-debug"],
+}
+eu_strip_flags = {
+    "ko": ["-g"],
+}
+
+
+# Compressed kernel modules we can scan
+compressed_modules = (".ko.xz", ".ko.zst", ".ko.gz")
+
+# e_type from the ELF header, as libmagic would describe it
+elf_types = {
+    1: "relocatable",
+    2: "executable",
+    3: "shared object",
+}
+
+
+def init_worker():
+    """ Give each examine worker its own long lived magic cookie """
+    global worker_magic
+
+    worker_magic = magic.open(magic.MAGIC_NONE)
+    worker_magic.load()
+
+
+def get_magic_string_fast(file):
+    """ Identify ELF objects and ar archives from their first bytes, in the
+        same terms libmagic would use, so they never need libmagic. """
+    if os.path.islink(file) or not os.path.isfile(file):
+        return None
+    with open(file, "rb") as fobj:
+        header = fobj.read(18)
+    if header.startswith(b"!<arch>\n"):
+        return "current ar archive"
+    if len(header) < 18 or not header.startswith(b"\x7fELF"):
+        return None
+    if header[5] != 1 or header[4] not in (1, 2):
+        return None
+    etype = header[16] | (header[17] << 8)
+    if etype not in elf_types:
+        return None
+    bits = 64 if header[4] == 2 else 32
+    return "ELF {}-bit LSB {},".format(bits, elf_types[etype])
+
+
+def get_magic_string(file):
+    """ Return the magic description for the given file """
+    mgs = get_magic_string_fast(file)
+    if mgs:
+        return mgs
+    if worker_magic is None:
+        init_worker()
+    return worker_magic.file(file)
+
+
+def classify_file(item):
+    """ Determine the magic for a file from within a worker """
+    package_name, pretty, file = item
+    try:
+        return package_name, pretty, file, get_magic_string(file), None
+    except Exception as e:
+        return package_name, pretty, file, None, e
+
 
 def is_pkgconfig_file(pretty, mgs):
     """ Simple as it sounds, work out if this is a pkgconfig file """
@@ -42,6 +147,53 @@ def is_pkgconfig_file(pretty, mgs):
     return False
 
 
+def read_pkgconfig(file):
+    """ Parse a .pc file much like pkg-config itself would, returning the
+        keyword fields with all variables expanded """
+    variables = {"pcfiledir": os.path.dirname(file)}
+    fields = dict()
+
+    def expand(value, depth=0):
+        if depth > 64:
+            return value
+        ret = pc_expand.sub(lambda m: variables.get(m.group(1), ""), value)
+        if ret != value and pc_expand.search(ret):
+            return expand(ret, depth + 1)
+        return ret
+
+    with open(file, "r", errors="replace") as inp:
+        content = inp.read().replace("\\\n", "")
+    for line in content.split("\n"):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        m = pc_keyword.match(line)
+        if m:
+            fields[m.group(1)] = expand(m.group(2)).replace("$$", "$")
+            continue
+        m = pc_variable.match(line)
+        if m:
+            variables[m.group(1)] = expand(m.group(2))
+    return fields
+
+
+def get_pkgconfig_requires(value):
+    """ Module names from a Requires list, i.e. "glib-2.0 >= 2.50, zlib" """
+    ret = list()
+    skip = False
+    value = pc_operator.sub(r" \1 ", value.replace(",", " "))
+    for item in value.split():
+        if skip:
+            skip = False
+            continue
+        if pc_operator.match(item):
+            # Drop the version too
+            skip = True
+            continue
+        ret.append(item)
+    return ret
+
+
 def is_soname_link(file, mgs):
     """ Used to detect soname links """
     if not file.endswith(".so"):
@@ -80,6 +232,47 @@ def is_system_map(file, mgs):
     return True
 
 
+def is_compressed_module(file):
+    """ Kernel modules compressed by the kernel's own install step """
+    if not file.endswith(compressed_modules):
+        return False
+    if os.path.islink(file) or not os.path.isfile(file):
+        return False
+    return True
+
+
+def read_module(file):
+    """ Return the (decompressed) contents of a kernel module """
+    if file.endswith(".ko.xz"):
+        opener = lzma.open
+    elif file.endswith(".ko.gz"):
+        opener = gzip.open
+    elif file.endswith(".ko.zst"):
+        if zstandard is None:
+            raise ElfError("zstandard unavailable for {}".format(file))
+        with open(file, "rb") as inp:
+            reader = zstandard.ZstdDecompressor().stream_reader(inp)
+            return reader.read()
+    else:
+        return None
+    with opener(file, "rb") as inp:
+        return inp.read()
+
+
+def get_modinfo(file, field):
+    """ Grab a field from the .modinfo section of a kernel module """
+    data = read_module(file)
+    with ElfFile(file, data=data) as elf:
+        modinfo = elf.get_section_data(".modinfo")
+    if modinfo is None:
+        return None
+    prefix = "{}=".format(field).encode("utf-8")
+    for entry in modinfo.split(b"\0"):
+        if entry.startswith(prefix):
+            return entry[len(prefix):].decode("utf-8", "surrogateescape")
+    return None
+
+
 class FileReport:
 
     pkgconfig_deps = None
@@ -98,16 +291,27 @@ class FileReport:
     dep_kernel = None
     prov_kernel = None
 
+    # Examine cache result for this file, if it was cacheable
+    cache_state = None
+    cache_key = None
+
+    # Strip mode, when stripping is deferred to a batch
+    strip_mode = None
+
+    # (debug section bytes before, and after, compression, seconds)
+    debug_stats = None
+
+    # DT_NEEDED libraries providing none of our undefined symbols
+    unused_libs = None
+
     def scan_kernel(self, file):
         """ Scan a .ko file to figure out which kernel this depends on """
-        cmd = "LC_ALL=C /sbin/modinfo --field=vermagic \"{}\"".format(file)
         try:
-            output = subprocess.check_output(cmd, shell=True)
+            line = get_modinfo(file, "vermagic")
         except Exception as e:
-            console_ui.emit_warning("File", "Failed to scan kernel modules for"
-                                    " path: {}".format(file))
+            line = self.scan_kernel_modinfo(file)
+        if not line:
             return
-        line = output.split("\n")[0]
         splits = line.strip().split(" ")
         if "modversions" not in splits:
             return
@@ -115,10 +319,45 @@ class FileReport:
             return
         self.dep_kernel = splits[0].strip()
 
+    def scan_kernel_modinfo(self, file):
+        """ Fallback for modules our own ELF reader cannot handle """
+        cmd = "LC_ALL=C /sbin/modinfo --field=vermagic \"{}\"".format(file)
+        try:
+            output = subprocess.check_output(cmd, shell=True)
+            output = output.decode("utf-8", "surrogateescape")
+        except Exception as e:
+            console_ui.emit_warning("File", "Failed to scan kernel modules for"
+                                    " path: {}".format(file))
+            return None
+        return output.split("\n")[0]
+
     def scan_binary(self, file, check_soname=False):
+        """ Grab the direct dependencies, rpaths and soname of the binary,
+            straight from the dynamic section if we're able to. """
+        try:
+            with ElfFile(file) as elf:
+                dyn = elf.get_dynamic()
+        except ElfError as e:
+            self.scan_binary_readelf(file, check_soname)
+            return
+
+        if dyn.rpaths:
+            if self.rpaths is None:
+                self.rpaths = set()
+            self.rpaths.update(dyn.rpaths)
+        if dyn.needed:
+            if self.symbol_deps is None:
+                self.symbol_deps = set()
+            self.symbol_deps.update(dyn.needed)
+        if check_soname and dyn.soname:
+            self.soname = dyn.soname
+
+    def scan_binary_readelf(self, file, check_soname=False):
+        """ Fallback for anything our own ELF reader cannot handle """
         cmd = "LC_ALL=C /usr/bin/readelf -d \"{}\"".format(file)
         try:
             output = subprocess.check_output(cmd, shell=True)
+            output = output.decode("utf-8", "surrogateescape")
         except Exception as e:
             console_ui.emit_warning("File", "Failed to scan binary deps for"
                                     " path: {}".format(file))
@@ -168,7 +407,7 @@ class FileReport:
         fobj = os.path.join(dirn, fpath)
 
         try:
-            mg = magic.detect_from_filename(fobj)
+            mg = get_magic_string(fobj)
         except Exception as e:
             return
 
@@ -179,10 +418,46 @@ class FileReport:
             self.soname_links = set()
         self.soname_links.add(fpath)
 
+    def scan_pkgconfig(self, file):
+        """ Find the name and requirements of a pkgconfig file """
+        self.pkgconfig_name = os.path.basename(file)[:-3]
+        try:
+            fields = read_pkgconfig(file)
+        except Exception as e:
+            console_ui.emit_warning("PKGCONFIG", "Cannot parse {}".
+                                    format(self.pretty))
+            print(e)
+            return
+        deps = set()
+        for field in ["Requires", "Requires.private"]:
+            if field in fields:
+                deps.update(get_pkgconfig_requires(fields[field]))
+        deps.discard(self.pkgconfig_name)
+        if len(deps) > 0:
+            self.pkgconfig_deps = deps
+
     def add_kernel_prov(self, file):
         self.prov_kernel = str(file.split("System.map-")[1])
 
-    def __init__(self, pretty, file, mgs):
+    def get_fields(self):
+        """ Serializable form of the fields we found by scanning the file """
+        ret = dict()
+        for field in REPORT_FIELDS:
+            val = getattr(self, field)
+            if isinstance(val, set):
+                val = sorted(val)
+            ret[field] = val
+        return ret
+
+    def set_fields(self, fields):
+        """ Restore the scanned fields, i.e. from the examine cache """
+        for field in REPORT_FIELDS:
+            val = fields.get(field, None)
+            if isinstance(val, list):
+                val = set(val)
+            setattr(self, field, val)
+
+    def __init__(self, pretty, file, mgs, fields=None):
         global share_ctx
         self.pretty = pretty
         self.file = file
@@ -194,6 +469,11 @@ class FileReport:
         if is_system_map(pretty, mgs):
             self.add_kernel_prov(file)
 
+        # Already scanned this content before
+        if fields is not None:
+            self.set_fields(fields)
+            return
+
         # Some things omit automatic dependencies
         if share_ctx.spec.pkg_autodep:
             if is_soname_link(file, mgs):
@@ -204,32 +484,30 @@ class FileReport:
                 self.scan_binary(file, False)
             elif v_rel.match(mgs) and file.endswith(".ko"):
                 self.scan_kernel(file)
+            elif is_compressed_module(file):
+                self.scan_kernel(file)
+
+
+def get_strip_env(context):
+    """ Environment for the strip tools, honouring the LTO toolchain """
+    env = dict(os.environ)
+    env["LC_ALL"] = "C"
+    if context.spec.pkg_optimize and not context.spec.pkg_clang:
+        if "thin-lto" in context.spec.pkg_optimize \
+                or "lto" in context.spec.pkg_optimize:
+            env["AR"] = "gcc-ar"
+            env["RANLIB"] = "gcc-ranlib"
+            env["NM"] = "gcc-nm"
+    return env
 
 
 def strip_file(context, pretty, file, magic_string, mode=None):
     """ Schedule a strip, basically. """
     if not context.spec.pkg_strip:
         return
-    exports = ["LC_ALL=C"]
-    if context.spec.pkg_optimize and not context.spec.pkg_clang:
-        if "thin-lto" in context.spec.pkg_optimize \
-                or "lto" in context.spec.pkg_optimize:
-            exports.extend([
-                "AR=\"gcc-ar\"",
-                "RANLIB=\"gcc-ranlib\"",
-                "NM=\"gcc-nm\""])
-
-    cmd = "{} strip {} \"{}\""
-    flags = ""
-    if mode == "shared":
-        flags = "--strip-unneeded"
-    elif mode == "ko":
-        flags = "-g --strip-unneeded"
-    elif mode == "ar":
-        flags = "--strip-debug"
+    cmd = ["strip"] + strip_flags.get(mode, []) + [file]
     try:
-        s = " ".join(exports)
-        subprocess.check_call(cmd.format(s, flags, file), shell=True)
+        subprocess.check_call(cmd, env=get_strip_env(context))
         console_ui.emit_info("Stripped", pretty)
     except Exception as e:
         console_ui.emit_warning("Strip", "Failed to strip '{}'".
@@ -239,62 +517,215 @@ def strip_file(context, pretty, file, magic_string, mode=None):
 
 def get_debug_path(context, file, magic_string):
     """ Grab the NT_GNU_BUILD_ID """
+    try:
+        with ElfFile(file) as elf:
+            v = elf.get_build_id()
+    except ElfError as e:
+        v = get_build_id_readelf(file)
+
+    if not v:
+        return None
+
+    libdir = "/usr/lib"
+    if "ELF 32" in magic_string:
+        libdir = "/usr/lib32"
+
+    path = os.path.join(libdir, "debug", ".build-id", v[0:2], v[2:])
+    return path + ".debug"
+
+
+def get_build_id_readelf(file):
+    """ Fallback for anything our own ELF reader cannot handle """
     cmd = "LC_ALL=C readelf -n \"{}\"".format(file)
     try:
         lines = subprocess.check_output(cmd, shell=True)
+        lines = lines.decode("utf-8", "surrogateescape")
     except Exception as e:
         return None
 
     for line in lines.split("\n"):
         if "Build ID:" not in line:
             continue
-        v = line.split(":")[1].strip()
+        return line.split(":")[1].strip()
+    return None
 
-        libdir = "/usr/lib"
-        if "ELF 32" in magic_string:
-            libdir = "/usr/lib32"
 
-        path = os.path.join(libdir, "debug", ".build-id", v[0:2], v[2:])
-        return path + ".debug"
+def get_strip_mode(file, mgs):
+    """ Determine how a file should be stripped, if at all """
+    if v_dyn.match(mgs):
+        return "shared"
+    if v_bin.match(mgs):
+        return "executable"
+    if v_rel.match(mgs):
+        # Kernel object in all probability
+        if file.endswith(".ko"):
+            return "ko"
+        return None
+    if mgs == "current ar archive":
+        return "ar"
     return None
 
 
+def get_debug_size(file):
+    """ Total size of the debug sections within an ELF object, as stored,
+        so compressed sections count at their compressed size """
+    try:
+        with ElfFile(file) as elf:
+            return sum([x.size for x in elf.sections
+                        if x.name and x.name.startswith(".debug_")])
+    except ElfError as e:
+        return 0
+
+
+def get_lto_mode(context):
+    """ LTO optimisations in use by the spec, if any """
+    if not context.spec.pkg_optimize:
+        return ""
+    return ",".join([x for x in context.spec.pkg_optimize if "lto" in x])
+
+
+def get_cache_flags(context, mode, debug_file):
+    """ Everything besides content that influences an examination """
+    if debug_file:
+        debug_file = remove_prefix(debug_file, context.get_install_dir())
+    return "mode={};strip={};debug={};lto={};clang={};compress={}".format(
+        mode, context.spec.pkg_strip, debug_file, get_lto_mode(context),
+        context.spec.pkg_clang, context.spec.pkg_debugcompress)
+
+
 def examine_file(*args):
     global share_ctx
-    package = args[0]
+    package_name = args[0]
     pretty = args[1]
     file = args[2]
     mgs = args[3]
 
     context = share_ctx
 
-    if v_dyn.match(mgs):
-        # Get soname, direct deps and strip
-        store_debug(context, pretty, file, mgs)
-        strip_file(context, pretty, file, mgs, mode="shared")
-    elif v_bin.match(mgs):
-        # Get direct deps, and strip
-        store_debug(context, pretty, file, mgs)
-        strip_file(context, pretty, file, mgs, mode="executable")
-    elif v_rel.match(mgs):
-        # Kernel object in all probability
-        if file.endswith(".ko"):
-            store_debug(context, pretty, file, mgs)
-            strip_file(context, pretty, file, mgs, mode="ko")
-    elif mgs == "current ar archive":
-        # Strip only.
-        strip_file(context, pretty, file, mgs, mode="ar")
+    mode = get_strip_mode(file, mgs)
+    debug = mode is not None and mode != "ar" and context.can_dbginfo \
+        and context.spec.pkg_debug
+    if mode is None or (not debug and not context.spec.pkg_strip):
+        # Nothing to strip, just report on it
+        return FileReport(pretty, file, mgs)
+
+    did_full = None
+    if debug:
+        did_full = get_debug_file(context, pretty, file, mgs)
+
+    key = None
+    if share_cache and share_cache.is_enabled():
+        try:
+            key = share_cache.get_key(file, get_cache_flags(context, mode,
+                                                            did_full))
+        except Exception as e:
+            key = None
+    if key:
+        fields = share_cache.lookup(key, file, did_full)
+        if fields is not None:
+            console_ui.emit_info("Cached", pretty)
+            freport = FileReport(pretty, file, mgs, fields=fields)
+            freport.cache_state = "hit"
+            return freport
+
+    if not debug:
+        # Strip only, which happens in batches once all files are examined.
+        # Stripping leaves the dynamic section alone, so scan right away.
+        freport = FileReport(pretty, file, mgs)
+        freport.strip_mode = mode
+        if key:
+            freport.cache_state = "miss"
+            freport.cache_key = key
+        return freport
+
+    # Get soname, direct deps and strip
+    debug_stats = None
+    if context.spec.pkg_debugcompress:
+        started = time.time()
+        raw_size = get_debug_size(file)
+    split_debug_and_strip(context, pretty, file, mgs, mode, did_full)
+    if context.spec.pkg_debugcompress and did_full and \
+            os.path.exists(did_full):
+        # Section sizes within the .debug file are the compressed ones
+        debug_stats = (raw_size, get_debug_size(did_full),
+                       time.time() - started)
 
     freport = FileReport(pretty, file, mgs)
+    freport.debug_stats = debug_stats
+    if key:
+        freport.cache_state = "miss"
+        if share_cache.store(key, freport.get_fields(), file, did_full):
+            freport.cache_state = "stored"
     return freport
 
 
-def store_debug(context, pretty, file, magic_string):
-    if not context.can_dbginfo:
-        return
-    if not context.spec.pkg_debug:
-        return
+def strip_batch(batch):
+    """ Strip a batch of files sharing a mode with a single strip run. When
+        the batch fails, retry each file alone so failures are attributed
+        to the right files. """
+    mode, reports = batch
+    context = share_ctx
+    env = get_strip_env(context)
+    flags = strip_flags.get(mode, [])
+
+    failed = list()
+    try:
+        subprocess.check_call(["strip"] + flags + [x.file for x in reports],
+                              env=env)
+    except Exception as e:
+        for report in reports:
+            try:
+                subprocess.check_call(["strip"] + flags + [report.file],
+                                      env=env)
+            except Exception as e:
+                failed.append(report.pretty)
+
+    # Now the stripped results may be cached
+    stored = 0
+    if share_cache:
+        for report in reports:
+            if not report.cache_key or report.pretty in failed:
+                continue
+            if share_cache.store(report.cache_key, report.get_fields(),
+                                 report.file, None):
+                stored += 1
+    return [x.pretty for x in reports], failed, stored
+
+
+def has_path_debug(context, file, mgs):
+    """ Whether the debug file of this object is named after its path rather
+        than its build-id, in which case each path needs its own """
+    if get_strip_mode(file, mgs) == "ar" or not context.can_dbginfo or \
+            not context.spec.pkg_debug:
+        return False
+    try:
+        with ElfFile(file) as elf:
+            return not elf.get_build_id()
+    except ElfError as e:
+        return True
+
+
+def get_content_key(item):
+    """ Hash a file for duplicate detection within a worker. Only files that
+        would produce identical results under any name qualify, i.e. those
+        whose debug file is named by build-id rather than by path. """
+    name, pretty, file, mgs = item
+    context = share_ctx
+    try:
+        if has_path_debug(context, file, mgs):
+            return pretty, None
+        return pretty, hash_file(file)
+    except Exception as e:
+        return pretty, None
+
+
+def examine_item(item):
+    """ Examine a file from within a worker, tagged with its package """
+    return item[0], examine_file(*item)
 
+
+def get_debug_file(context, pretty, file, magic_string):
+    """ Work out where the .debug file goes, and ensure the tree exists """
     did = get_debug_path(context, file, magic_string)
 
     if did is None:
@@ -313,32 +744,135 @@ def store_debug(context, pretty, file, magic_string):
         pass
     if not os.path.exists(dirs):
         console_ui.emit_error("Debug", "Failed to make directory")
+        return None
+    return did_full
+
+
+def get_keep_debug_cmd(context, file, did_full):
+    """ objcopy command to write the .debug file, compressing its sections
+        here when asked to, as the debuglink CRC must match the result """
+    cmd = ["objcopy", "--only-keep-debug"]
+    if context.spec.pkg_debugcompress:
+        cmd.append("--compress-debug-sections={}".format(
+                   context.spec.pkg_debugcompress))
+    return cmd + [file, did_full]
+
+
+def store_debug(context, pretty, file, magic_string, did_full=None):
+    """ Split the debug information out without stripping the file """
+    if not context.can_dbginfo:
+        return
+    if not context.spec.pkg_debug:
         return
 
-    cmd = "objcopy --only-keep-debug \"{}\" \"{}\"".format(file, did_full)
+    if did_full is None:
+        did_full = get_debug_file(context, pretty, file, magic_string)
+    if did_full is None:
+        return
+
+    cmd = get_keep_debug_cmd(context, file, did_full)
     try:
-        subprocess.check_call(cmd, shell=True)
+        subprocess.check_call(cmd)
     except Exception as e:
         console_ui.emit_warning("objcopy", "Failed --only-keep-debug")
         return
-    cmd = "objcopy --add-gnu-debuglink=\"{}\" \"{}\"".format(did_full,
-                                                             file)
+    cmd = ["objcopy", "--add-gnu-debuglink={}".format(did_full), file]
     try:
-        subprocess.check_call(cmd, shell=True)
+        subprocess.check_call(cmd)
     except Exception as e:
         console_ui.emit_warning("objcopy", "Failed --add-gnu-debuglink")
         return
 
 
+def get_eu_strip():
+    """ Find elfutils' strip, which can split and strip in a single run """
+    global eu_strip
+
+    if eu_strip is None:
+        eu_strip = shutil.which("eu-strip") or ""
+    return eu_strip
+
+
+def split_debug_eu_strip(context, pretty, file, did_full, mode):
+    """ Strip the file, writing the debug file and debuglink in one go """
+    tool = get_eu_strip()
+    if not tool or context.spec.pkg_debugcompress:
+        return False
+    cmd = [tool] + eu_strip_flags.get(mode, []) + ["-f", did_full, file]
+    try:
+        subprocess.check_call(cmd, env=get_strip_env(context))
+    except Exception as e:
+        console_ui.emit_warning("eu-strip", "Failed to split '{}', "
+                                "falling back to objcopy".format(pretty))
+        return False
+    return True
+
+
+def split_debug_objcopy(context, pretty, file, did_full, mode):
+    """ binutils only toolchain: keep the debug info, then strip and add
+        the debuglink within the same objcopy run """
+    cmd = get_keep_debug_cmd(context, file, did_full)
+    try:
+        subprocess.check_call(cmd)
+    except Exception as e:
+        console_ui.emit_warning("objcopy", "Failed --only-keep-debug")
+        strip_file(context, pretty, file, None, mode=mode)
+        return False
+
+    cmd = ["objcopy"] + objcopy_strip_flags.get(mode, []) + \
+        ["--add-gnu-debuglink={}".format(did_full), file]
+    try:
+        subprocess.check_call(cmd, env=get_strip_env(context))
+    except Exception as e:
+        console_ui.emit_warning("objcopy", "Failed to strip '{}' with "
+                                "--add-gnu-debuglink".format(pretty))
+        print(e)
+        # Still ship it stripped, just without the debuglink
+        strip_file(context, pretty, file, None, mode=mode)
+        return False
+    return True
+
+
+def split_debug_and_strip(context, pretty, file, magic_string, mode,
+                          did_full=None):
+    """ Split the debug information out of an ELF file and strip it, using
+        as few tool invocations as the toolchain will allow us. """
+    if not context.can_dbginfo or not context.spec.pkg_debug:
+        strip_file(context, pretty, file, magic_string, mode=mode)
+        return
+    if not context.spec.pkg_strip:
+        store_debug(context, pretty, file, magic_string, did_full)
+        return
+
+    if did_full is None:
+        did_full = get_debug_file(context, pretty, file, magic_string)
+    if did_full is None:
+        strip_file(context, pretty, file, magic_string, mode=mode)
+        return
+
+    if split_debug_eu_strip(context, pretty, file, did_full, mode) or \
+            split_debug_objcopy(context, pretty, file, did_full, mode):
+        console_ui.emit_info("Stripped", pretty)
+
+
 class PackageExaminer:
     """ Responsible for identifying files suitable for further examination,
         such as those that should be removed, checked for dependencies,
         providers, and even those that should be stripped
     """
 
-    def __init__(self):
+    def __init__(self, jobs=None, cache=None):
         self.libtool_file = re.compile("libtool library file, ASCII text.*")
         self.can_kernel = True
+        # Worker count, defaulting to the build job count
+        self.jobs = jobs
+        # ExamineCache to skip re-stripping identical files
+        self.cache = cache
+        # Examine files with identical content only once, not just hardlinks
+        self.dedupe_content = True
+        # Look for libraries linked but never used. Opt-in, as it reads the
+        # dynamic symbols of every binary and each library it needs.
+        self.check_overlinking = False
 
     def should_nuke_file(self, context, pretty, file, mgs):
         # it's not that we hate.. Actually, no, we do. We hate you libtool.
@@ -366,6 +900,8 @@ class PackageExaminer:
             return True
         if is_pkgconfig_file(pretty, mgs):
             return True
+        if self.can_kernel and is_compressed_module(file):
+            return True
         if is_soname_link(file, mgs):
             return True
         if is_static_archive(file, mgs):
@@ -374,30 +910,245 @@ class PackageExaminer:
             return True
         return False
 
+    def group_aliases(self, context, pool, interest):
+        """ Group the files we'd strip by inode, and optionally by content,
+            returning the representatives to examine and a mapping of each
+            representative to its aliases. Each alias is paired with the path
+            it should be hardlinked to, or None if it must become a copy. """
+        groups = dict()
+        ret = list()
+        for item in interest:
+            name, pretty, fpath, mgs = item
+            if get_strip_mode(fpath, mgs) is None:
+                ret.append(item)
+                continue
+            st = os.lstat(fpath)
+            key = (st.st_dev, st.st_ino)
+            if key not in groups:
+                groups[key] = list()
+            groups[key].append(item)
+
+        # A debug file named after the lead's path is useless to hardlinks
+        # elsewhere, so give each path its own copy to be split on its own
+        for key in list(groups):
+            group = groups[key]
+            if len(group) < 2:
+                continue
+            group.sort(key=lambda x: x[1])
+            if not has_path_debug(context, group[0][2], group[0][3]):
+                continue
+            try:
+                for item in group[1:]:
+                    replace_file(item[2], item[2])
+            except Exception as e:
+                console_ui.emit_warning("Examine", "Failed to unlink {}: {}".
+                                        format(item[1], e))
+                continue
+            ret.extend(group)
+            del groups[key]
+
+        # Each inode is led by one path, the rest are hardlinks to it
+        leads = dict()
+        for key in groups:
+            groups[key].sort(key=lambda x: x[1])
+            leads[key] = groups[key][0]
+
+        # Merge inode groups with identical content
+        merged = dict()
+        for key in leads:
+            merged[key] = [key]
+        if self.dedupe_content and len(leads) > 1:
+            by_size = dict()
+            for key, lead in leads.items():
+                size = os.lstat(lead[2]).st_size
+                if size not in by_size:
+                    by_size[size] = list()
+                by_size[size].append(key)
+            candidates = dict()
+            for size in by_size:
+                if len(by_size[size]) < 2:
+                    continue
+                for key in by_size[size]:
+                    candidates[leads[key][1]] = key
+            lead_items = [leads[x] for x in candidates.values()]
+            by_hash = dict()
+            for pretty, digest in pool.imap_unordered(get_content_key,
+                                                      lead_items):
+                if digest is None:
+                    continue
+                key = candidates[pretty]
+                if digest not in by_hash:
+                    by_hash[digest] = list()
+                by_hash[digest].append(key)
+            for digest in by_hash:
+                keys = sorted(by_hash[digest], key=lambda x: leads[x][1])
+                for key in keys[1:]:
+                    merged[keys[0]].extend(merged.pop(key))
+
+        aliases = dict()
+        for key in merged:
+            rep = leads[key]
+            ret.append(rep)
+            links = list()
+            for other in merged[key]:
+                group = groups[other]
+                if other != key:
+                    links.append((group[0], None))
+                for alias in group[1:]:
+                    links.append((alias, group[0][2]))
+            if len(links) > 0:
+                aliases[rep[1]] = links
+        return ret, aliases
+
+    def strip_batches(self, pool, reports, jobs):
+        """ Strip everything that was deferred, batching files by mode """
+        modes = dict()
+        for report in reports:
+            if not report.strip_mode:
+                continue
+            if report.strip_mode not in modes:
+                modes[report.strip_mode] = list()
+            modes[report.strip_mode].append(report)
+
+        batches = list()
+        for mode in sorted(modes):
+            files = sorted(modes[mode], key=lambda x: x.pretty)
+            # Spread work over the pool, within a sane command line length
+            size = max(1, min(MAX_STRIP_BATCH, -(-len(files) // jobs)))
+            batch = list()
+            length = 0
+            for report in files:
+                if len(batch) >= size or \
+                        length + len(report.file) > MAX_STRIP_ARGS:
+                    batches.append((mode, batch))
+                    batch = list()
+                    length = 0
+                batch.append(report)
+                length += len(report.file) + 1
+            if len(batch) > 0:
+                batches.append((mode, batch))
+
+        for pretties, failed, stored in pool.imap_unordered(strip_batch,
+                                                            batches):
+            for pretty in pretties:
+                if pretty in failed:
+                    console_ui.emit_warning("Strip", "Failed to strip '{}'".
+                                            format(pretty))
+                    continue
+                console_ui.emit_info("Stripped", pretty)
+            if self.cache:
+                self.cache.stores += stored
+        if len(batches) > 0:
+            count = sum([len(x[1]) for x in batches])
+            console_ui.emit_info("Strip", "Batched {} files into {} strip "
+                                 "runs".format(count, len(batches)))
+
+    def find_overlinking(self, pool, context, reports):
+        """ Flag needed libraries whose symbols the binary never uses, which
+            only cost startup time. Runs once the files are stripped, as the
+            dynamic symbol table survives that. """
+        install_dir = context.get_install_dir()
+        items = [(install_dir, x) for x in reports
+                 if x.symbol_deps and not x.pretty.endswith(".ko")]
+        files = dict([(x[1].pretty, x[1]) for x in items])
+        count = 0
+        for pretty, unused in pool.imap_unordered(find_unused_libraries,
+                                                  items):
+            if not unused:
+                continue
+            files[pretty].unused_libs = unused
+            count += 1
+            console_ui.emit_warning("Overlink", "{} links unused: {}".format(
+                                    pretty, ", ".join(unused)))
+        if count > 0:
+            console_ui.emit_info("Overlink", "{} files link unused libraries,"
+                                 " consider -Wl,--as-needed".format(count))
+
+    def apply_alias(self, report, alias, link):
+        """ Make alias match the examined representative, and give it its
+            own copy of the representative's FileReport """
+        name, pretty, fpath, mgs = alias
+        try:
+            if link:
+                # The strip replaced the inode, so restore the hardlink
+                os.unlink(fpath)
+                os.link(link, fpath)
+            else:
+                replace_file(report.file, fpath)
+        except Exception as e:
+            console_ui.emit_warning("Examine", "Failed to update duplicate "
+                                    "{}: {}".format(pretty, e))
+        ret = copy.copy(report)
+        ret.pretty = pretty
+        ret.file = fpath
+        ret.emul32 = pretty.startswith("/usr/lib32/") or \
+            pretty.startswith("/lib32")
+        ret.cache_state = None
+        ret.cache_key = None
+        ret.strip_mode = None
+        ret.debug_stats = None
+        return ret
+
+    def emit_debug_stats(self, examinations):
+        """ Report how compressing the debug sections went per package """
+        for name in sorted(examinations):
+            stats = [x.debug_stats for x in examinations[name]
+                     if x.debug_stats]
+            if len(stats) == 0:
+                continue
+            before = sum([x[0] for x in stats])
+            after = sum([x[1] for x in stats])
+            spent = sum([x[2] for x in stats])
+            console_ui.emit_info("Debug", "{}: {:.2f} MiB of debug sections "
+                                 "compressed to {:.2f} MiB in {:.2f}s".format(
+                                     name, before / 1048576.0,
+                                     after / 1048576.0, spent))
+
     def examine_package(self, context, package):
         """ Examine the given package and update symbols, etc. """
+        examinations = self.examine_packages(context, [package])
+        if examinations is None:
+            return False
+        return examinations.get(package.name, list())
+
+    def examine_packages(self, context, packages):
+        """ Examine all packages, in order to update dependencies, etc.
+            A single pool serves every package, so small subpackages don't
+            leave the machine idle while we wait on the next one. """
+        console_ui.emit_info("Examine", "Examining packages")
         install_dir = context.get_install_dir()
 
         global share_ctx
+        global share_cache
 
         share_ctx = context
+        share_cache = self.cache
 
         # Right now we actually only care about magic matching
-        removed = set()
-
-        pool = multiprocessing.Pool()
-        results = list()
+        removed = dict()
+        interest = list()
+        examinations = dict()
 
-        for file in package.emit_files():
-            if file[0] == '/':
-                file = file[1:]
-            fpath = os.path.join(install_dir, file)
-            try:
-                mgs = magic.detect_from_filename(fpath).mime_type
-            except Exception as e:
-                print(e)
+        items = list()
+        for package in packages:
+            removed[package.name] = set()
+            for file in package.iter_files():
+                if file[0] == '/':
+                    file = file[1:]
+                items.append((package.name, "/" + file,
+                              os.path.join(install_dir, file)))
+
+        jobs = self.jobs if self.jobs else context.build.jobcount
+        pool = multiprocessing.Pool(processes=jobs, initializer=init_worker)
+
+        # Classification happens in the workers, we only make decisions
+        chunk = max(1, min(64, len(items) // (jobs * 4)))
+        for name, pretty, fpath, mgs, err in pool.imap_unordered(
+                classify_file, items, chunk):
+            if mgs is None:
+                print(err)
                 continue
-            if self.should_nuke_file(context, "/" + file, fpath, mgs):
+            if self.should_nuke_file(context, pretty, fpath, mgs):
                 try:
                     if os.path.isfile(fpath):
                         os.unlink(fpath)
@@ -406,36 +1157,66 @@ class PackageExaminer:
                 except Exception as e:
                     console_ui.emit_error("Clean", "Failed to remove unwanted"
                                           "file: {}".format(e))
-                    return False
+                    pool.terminate()
+                    return None
                 console_ui.emit_info("Clean", "Removed unwanted file: {}".
-                                     format("/" + file))
-                removed.add("/" + file)
+                                     format(pretty))
+                removed[name].add(pretty)
                 continue
 
-            if not self.file_is_of_interest("/" + file, fpath, mgs):
+            if not self.file_is_of_interest(pretty, fpath, mgs):
                 continue
-            # Handle this asynchronously
-            results.append(pool.apply_async(examine_file, [
-                           package, "/" + file, fpath, mgs],
-                           callback=None))
+            interest.append((name, pretty, fpath, mgs))
+
+        # Only examine one of each set of hardlinks/duplicates
+        interest, aliases = self.group_aliases(context, pool, interest)
+
+        # Now examine everything of interest, mapping back as we go
+        reports = list()
+        for name, report in pool.imap_unordered(examine_item, interest):
+            if name not in examinations:
+                examinations[name] = list()
+            examinations[name].append(report)
+            reports.append(report)
+            if self.cache and report.cache_state:
+                if report.cache_state == "hit":
+                    self.cache.hits += 1
+                else:
+                    self.cache.misses += 1
+                if report.cache_state == "stored":
+                    self.cache.stores += 1
+
+        self.strip_batches(pool, reports, jobs)
+
+        if self.check_overlinking:
+            self.find_overlinking(pool, context, reports)
 
         pool.close()
         pool.join()
 
-        infos = [x.get() for x in results]
+        # Files are in their final state, so bring the duplicates in line
+        for report in reports:
+            for alias, link in aliases.get(report.pretty, list()):
+                if alias[0] not in examinations:
+                    examinations[alias[0]] = list()
+                examinations[alias[0]].append(
+                    self.apply_alias(report, alias, link))
+                console_ui.emit_info("Duplicate", "{} is the same file as {}".
+                                     format(alias[1], report.pretty))
 
-        for r in removed:
-            package.remove_file(r)
-        return infos
+        if context.spec.pkg_debugcompress:
+            self.emit_debug_stats(examinations)
 
-    def examine_packages(self, context, packages):
-        """ Examine all packages, in order to update dependencies, etc """
-        console_ui.emit_info("Examine", "Examining packages")
+        if self.cache and self.cache.is_enabled():
+            self.cache.prune()
+            self.cache.emit_stats()
 
-        examinations = dict()
         for package in packages:
-            ir = self.examine_package(context, package)
-            if not ir:
-                continue
-            examinations[package.name] = ir
+            for r in removed[package.name]:
+                package.remove_file(r)
+
+        # Workers complete in any order, while dependency resolution and
+        # its output rely on the files coming in path order
+        for name in examinations:
+            examinations[name].sort(key=lambda x: x.pretty)
         return examinations
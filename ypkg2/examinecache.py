@@ -0,0 +1,209 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+from . import console_ui
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# Default cap on the cache size, in MiB. The cache is opt-in, as filling it
+# costs an extra copy of every output on filesystems without reflinks,
+# which one-off builds never get back.
+DEFAULT_CACHE_SIZE = 0
+
+# FICLONE ioctl, allowing CoW copies on btrfs/xfs
+FICLONE = 0x40049409
+
+# Fields of the FileReport we're able to restore from the cache
+REPORT_FIELDS = ["soname", "symbol_deps", "rpaths", "dep_kernel"]
+
+
+def clone_file(source, dest):
+    """ Reflink source to dest if the filesystem allows it, otherwise fall
+        back to a plain copy. """
+    with open(source, "rb") as src:
+        with open(dest, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError as e:
+                pass
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def replace_file(source, dest):
+    """ Atomically replace dest with a copy of source, preserving the mode of
+        dest if it already exists """
+    if os.path.exists(dest):
+        mode = os.stat(dest).st_mode
+    else:
+        mode = os.stat(source).st_mode
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest),
+                               prefix=".ypkg-copy")
+    os.close(fd)
+    try:
+        clone_file(source, tmp)
+        os.chmod(tmp, mode)
+        os.rename(tmp, dest)
+    except Exception as e:
+        os.unlink(tmp)
+        raise
+
+
+def hash_file(path):
+    """ sha256 of the given file """
+    h = hashlib.sha256()
+    with open(path, "rb") as inp:
+        for chunk in iter(lambda: inp.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_tool_stamp(tools):
+    """ Identify the strip tools in use, so a toolchain update invalidates
+        anything they produced previously. """
+    stamps = list()
+    for tool in tools:
+        path = shutil.which(tool)
+        if not path:
+            continue
+        st = os.stat(path)
+        stamps.append("{}:{}:{}".format(path, st.st_size, st.st_mtime_ns))
+    return ";".join(stamps)
+
+
+class ExamineCache:
+    """ Content addressed store of examination results. Each entry is keyed
+        by the hash of the file prior to stripping plus everything that would
+        influence the strip and debug split, and holds the FileReport fields,
+        the stripped file and the split debug file. """
+
+    root = None
+    max_size = 0
+
+    hits = 0
+    misses = 0
+    stores = 0
+    evicted = 0
+
+    tool_stamp = None
+
+    def __init__(self, root, max_size=DEFAULT_CACHE_SIZE):
+        self.root = root
+        self.max_size = max_size * 1024 * 1024
+
+    def is_enabled(self):
+        return self.max_size > 0
+
+    def get_key(self, file, flags):
+        """ Compute the entry key for the file and its examine flags """
+        if self.tool_stamp is None:
+            self.tool_stamp = get_tool_stamp(["eu-strip", "objcopy",
+                                              "strip"])
+        h = hashlib.sha256()
+        h.update(hash_file(file).encode("utf-8"))
+        h.update(flags.encode("utf-8"))
+        h.update(self.tool_stamp.encode("utf-8"))
+        return h.hexdigest()
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.root, key[0:2], key)
+
+    def lookup(self, key, file, debug_file):
+        """ Restore a cached result over file (and debug_file), returning the
+            report fields, or None on a miss """
+        entry = self.get_entry_dir(key)
+        report = os.path.join(entry, "report.json")
+        try:
+            with open(report, "r") as inp:
+                fields = json.load(inp)
+
+            stripped = os.path.join(entry, "stripped")
+            if os.path.exists(stripped):
+                replace_file(stripped, file)
+            debug = os.path.join(entry, "debug")
+            if debug_file and os.path.exists(debug):
+                replace_file(debug, debug_file)
+            # Most recently used entries survive eviction
+            os.utime(entry)
+        except Exception as e:
+            return None
+        return fields
+
+    def store(self, key, fields, file, debug_file):
+        """ Store the result of an examination """
+        entry = self.get_entry_dir(key)
+        if os.path.exists(entry):
+            return True
+        try:
+            os.makedirs(os.path.dirname(entry), mode=0o0755, exist_ok=True)
+            tmp = tempfile.mkdtemp(dir=os.path.dirname(entry),
+                                   prefix=".tmp-")
+        except Exception as e:
+            return False
+        try:
+            if file:
+                clone_file(file, os.path.join(tmp, "stripped"))
+            if debug_file and os.path.exists(debug_file):
+                clone_file(debug_file, os.path.join(tmp, "debug"))
+            with open(os.path.join(tmp, "report.json"), "w") as out:
+                json.dump(fields, out)
+            os.rename(tmp, entry)
+        except Exception as e:
+            # Lost the race to another worker, or the disk is full
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        return True
+
+    def get_entries(self):
+        """ Return (mtime, size, path) for every entry in the cache """
+        entries = list()
+        if not os.path.exists(self.root):
+            return entries
+        for prefix in os.listdir(self.root):
+            pdir = os.path.join(self.root, prefix)
+            if not os.path.isdir(pdir):
+                continue
+            for key in os.listdir(pdir):
+                entry = os.path.join(pdir, key)
+                size = 0
+                try:
+                    for item in os.listdir(entry):
+                        size += os.path.getsize(os.path.join(entry, item))
+                    mtime = os.stat(entry).st_mtime
+                except Exception as e:
+                    continue
+                entries.append((mtime, size, entry))
+        return entries
+
+    def prune(self):
+        """ Evict the least recently used entries until we're under the size
+            cap again """
+        entries = sorted(self.get_entries())
+        total = sum([x[1] for x in entries])
+        for mtime, size, entry in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            self.evicted += 1
+
+    def emit_stats(self):
+        console_ui.emit_info("Cache", "Examine cache: {} hits, {} misses, "
+                             "{} stored, {} evicted".format(
+                                 self.hits, self.misses, self.stores,
+                                 self.evicted))
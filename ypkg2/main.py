@@ -19,8 +19,11 @@ from .ypkgcontext import YpkgContext
 from .scripts import ScriptGenerator
 from .packages import PackageGenerator, PRIORITY_USER
 from .examine import PackageExaminer
+from .examinecache import ExamineCache, DEFAULT_CACHE_SIZE
 from . import metadata
+from . import overlink
 from .dependencies import DependencyResolver
+from .deptrace import ResolverTrace
 from . import packager_name, packager_email
 from . import EMUL32PC
 
@@ -56,6 +59,23 @@ def main():
                         type=int, default=-1)
     parser.add_argument("-D", "--output-dir", type=str,
                         help="Set the output directory for resulting files")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Number of workers used to examine files")
+    parser.add_argument("--cache-size", type=int,
+                        default=DEFAULT_CACHE_SIZE,
+                        help="Enable the examine cache, capped at this "
+                        "many MiB")
+    parser.add_argument("--verify-deps", action="store_true",
+                        help="Check dependency providers exist on the host")
+    parser.add_argument("--trace-deps", type=str,
+                        help="Write a JSON or CSV report of every "
+                        "dependency lookup")
+    parser.add_argument("--reduce-deps", action="store_true",
+                        help="Drop dependencies implied by other "
+                        "dependencies")
+    parser.add_argument("--overlink-report", type=str,
+                        help="Look for linked but unused libraries, "
+                        "writing a JSON report")
     # Main file
     parser.add_argument("filename", help="Path to the ypkg YAML file to build",
                         nargs='?')
@@ -71,6 +91,8 @@ def main():
         show_version()
     if args.timestamp > 0:
         metadata.history_timestamp = args.timestamp
+    if args.reduce_deps:
+        metadata.reduce_dependencies = True
 
     if args.output_dir:
         od = args.output_dir
@@ -98,7 +120,15 @@ def main():
                               "or as the root user (not recommended)")
         sys.exit(1)
 
-    build_package(args.filename, outputDir)
+    if args.jobs is not None and args.jobs < 1:
+        console_ui.emit_error("Opt", "Invalid job count: {}".
+                              format(args.jobs))
+        sys.exit(1)
+
+    build_package(args.filename, outputDir, jobs=args.jobs,
+                  cache_size=args.cache_size, verify_deps=args.verify_deps,
+                  trace_deps=args.trace_deps,
+                  overlink_report=args.overlink_report)
 
 
 def clean_build_dirs(context):
@@ -168,7 +198,9 @@ def execute_step(context, step, step_n, work_dir):
     return True
 
 
-def build_package(filename, outputDir):
+def build_package(filename, outputDir, jobs=None,
+                  cache_size=DEFAULT_CACHE_SIZE, verify_deps=False,
+                  trace_deps=None, overlink_report=None):
     """ Will in future be moved to a separate part of the module """
     spec = YpkgSpec()
     if not spec.load_from_path(filename):
@@ -363,7 +395,7 @@ def build_package(filename, outputDir):
 
     # Add user patterns - each consecutive package has higher priority than the
     # package before it, ensuring correct levels of control
-    gene = PackageGenerator(spec)
+    gene = PackageGenerator(spec, install_dir=ctx.get_install_dir())
     count = 0
     for pkg in spec.patterns:
         for pt in spec.patterns[pkg]:
@@ -400,23 +432,44 @@ def build_package(filename, outputDir):
             print(e)
             sys.exit(1)
 
-    exa = PackageExaminer()
+    cache = ExamineCache(os.path.join(ctx.get_build_prefix(), "cache",
+                                      "examine"), max_size=cache_size)
+    exa = PackageExaminer(jobs=jobs, cache=cache)
     # Avoid expensive self calculations for kernels
     exa.can_kernel = True
     if spec.get_component("main") == "kernel.image":
         exa.can_kernel = False
+    if overlink_report:
+        exa.check_overlinking = True
 
     exaResults = exa.examine_packages(ctx, list(gene.packages.values()))
     if exaResults is None:
         console_ui.emit_error("Package", "Failed to correctly examine all "
                               "packages.")
         sys.exit(1)
+    if overlink_report:
+        try:
+            overlink.write_report(overlink_report, exaResults)
+        except Exception as e:
+            console_ui.emit_warning("Overlink", "Failed to write {}".
+                                    format(overlink_report))
+            print(e)
 
-    deps = DependencyResolver()
+    deps = DependencyResolver(verify_host=verify_deps)
+    if trace_deps:
+        deps.trace = ResolverTrace(trace_deps)
     if not deps.compute_for_packages(ctx, gene, exaResults):
         console_ui.emit_error("Dependencies", "Failed to compute all"
                               " dependencies")
         sys.exit(1)
+    if deps.trace:
+        deps.trace.emit_summary()
+        try:
+            deps.trace.write()
+        except Exception as e:
+            console_ui.emit_warning("Trace", "Failed to write {}".
+                                    format(trace_deps))
+            print(e)
 
     dbgs = ["/usr/lib64/debug", "/usr/lib/debug", "/usr/lib32/debug"]
     if ctx.can_dbginfo:
@@ -444,8 +497,7 @@ def build_package(filename, outputDir):
     # TODO: Ensure main is always first
     for package in sorted(gene.packages):
         pkg = gene.packages[package]
-        files = sorted(pkg.emit_files())
-        if len(files) == 0:
+        if len(pkg.emit_files()) == 0:
             console_ui.emit_info("Package", "Skipping empty package: {}".
                                  format(package))
             continue
@@ -24,8 +24,10 @@ import subprocess
 from collections import OrderedDict
 import datetime
 import calendar
+import re
 import sys
 
+pkgconfig_dep = re.compile(r"^pkgconfig(32)?\((.*)\)$")
 
 FileTypes = OrderedDict([
     ("/usr/lib/pkgconfig", "data"),
@@ -52,6 +54,9 @@ history_date = None
 fallback_timestamp = None
 fallback_date = None
 
+# Drop dependencies implied by the runtime dependencies of another one
+reduce_dependencies = False
+
 accum_packages = dict()
 
 
@@ -116,7 +121,7 @@ def create_files_xml(context, package):
 
     # TODO: Remove reliance on inary.util functions completely.
 
-    for path in sorted(package.emit_files()):
+    for path in package.emit_files():
         if path[0] == '/':
             path = path[1:]
 
@@ -255,6 +260,75 @@ global idb
 
 idb = None
 
+# Installed package -> [(dependency, release bound)]
+runtime_deps = dict()
+# Installed package -> {reachable package: highest release bound}
+runtime_closures = dict()
+
+
+def get_release_bound(dep):
+    """ Lowest release a dependency accepts, 0 if it doesn't say """
+    for val in [dep.release, dep.releaseFrom]:
+        if not val:
+            continue
+        try:
+            return int(val)
+        except ValueError:
+            pass
+    return 0
+
+
+def get_runtime_deps(name):
+    """ Direct runtime dependencies of an installed package """
+    global idb
+
+    if name in runtime_deps:
+        return runtime_deps[name]
+    ret = list()
+    try:
+        deps = idb.get_package(name).packageDependencies
+    except Exception as e:
+        deps = None
+    for dep in deps or []:
+        ret.append((str(dep.package), get_release_bound(dep)))
+    runtime_deps[name] = ret
+    return ret
+
+
+def get_runtime_closure(name):
+    """ Every package the installed package pulls in, with the highest
+        release any of the dependencies on it demand """
+    if name in runtime_closures:
+        return runtime_closures[name]
+    ret = dict()
+    pending = [name]
+    seen = set(pending)
+    while len(pending) > 0:
+        for dep, bound in get_runtime_deps(pending.pop()):
+            ret[dep] = max(ret.get(dep, 0), bound)
+            if dep not in seen:
+                seen.add(dep)
+                pending.append(dep)
+    runtime_closures[name] = ret
+    return ret
+
+
+def reduce_external_deps(candidates):
+    """ Find the candidates (name -> release we need) which are already
+        pulled in, at that release or newer, by another candidate. Returns
+        a mapping of removed name to the dependency implying it. """
+    removed = dict()
+    for dep in sorted(candidates):
+        for other in sorted(candidates):
+            # Mutual dependencies must keep one of the pair
+            if other == dep or other in removed:
+                continue
+            closure = get_runtime_closure(other)
+            if dep in closure and closure[dep] >= candidates[dep]:
+                removed[dep] = other
+                break
+    return removed
+
 
 def handle_dependencies(context, gene, metadata, package, files):
     """ Insert providers and dependencies into the spec """
@@ -274,11 +348,14 @@ def handle_dependencies(context, gene, metadata, package, files):
             conf.package = str(item)
             metadata.package.conflicts.append(conf)
 
-    if len(package.provided_symbols) > 0:
-        for sym in package.provided_symbols:
-            spc = None
-            name = None
-
+    # inary has no pkgconfig32() provides, the -32bit name sets them apart
+    for sym in sorted(package.provided_symbols):
+        g = pkgconfig_dep.match(sym)
+        if not g:
+            continue
+        if not metadata.package.providesPkgConfig:
+            metadata.package.providesPkgConfig = list()
+        metadata.package.providesPkgConfig.append(str(g.group(2)))
 
     all_names = set()
     for i in gene.packages:
@@ -305,7 +382,13 @@ def handle_dependencies(context, gene, metadata, package, files):
         if "32bit" in gene.packages:
             dependencies.add(context.spec.get_package_name("32bit"))
 
-    for dependency in dependencies:
+    newDeps = list()
+    candidates = dict()
+    explicit = set()
+    if package.name in context.spec.rundeps:
+        explicit.update(context.spec.rundeps[package.name])
+
+    for dependency in sorted(dependencies):
         release = context.spec.pkg_release
 
         newDep = inary.analyzer.dependency.Dependency()
@@ -326,10 +409,23 @@ def handle_dependencies(context, gene, metadata, package, files):
                 newDep.release = str(pkg.release)
             else:
                 newDep.releaseFrom = str(pkg.release)
+                if dependency not in explicit:
+                    candidates[dependency] = get_release_bound(newDep)
         else:
             newDep.package = dependency
             newDep.release = str(release)
 
+        newDeps.append(newDep)
+
+    removed = dict()
+    if reduce_dependencies and len(candidates) > 1:
+        removed = reduce_external_deps(candidates)
+    for newDep in newDeps:
+        if newDep.package in removed:
+            console_ui.emit_info("Dependency", "{}: dropped {}, implied by {}".
+                                 format(package.name, newDep.package,
+                                        removed[newDep.package]))
+            continue
         metadata.package.packageDependencies.append(newDep)
 
     if package.name not in context.spec.rundeps:
@@ -494,7 +590,7 @@ def write_spec(context, gene, outputDir):
             setattr(specPkg, item, getattr(package.package, item))
 
         # Now the fun bit.
-        for f in sorted(gene.packages[pkg].emit_files()):
+        for f in gene.packages[pkg].emit_files():
             fc = inary.data.specfile.Path()
             fc.path = f
             fc.fileType = get_file_type(f)
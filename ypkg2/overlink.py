@@ -0,0 +1,99 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+from . import console_ui
+from .dependencies import LibrarySearchModel
+from .elf import ElfFile, ElfError
+
+import json
+import os
+
+# (ELF class, exported symbols) of every library a worker has read
+library_exports = dict()
+
+search_model = LibrarySearchModel()
+
+
+def get_library_exports(path):
+    """ Exported symbols of the library at path, or None if unreadable """
+    if path in library_exports:
+        return library_exports[path]
+    ret = None
+    try:
+        with ElfFile(path) as elf:
+            ret = (elf.elfclass, elf.get_dynamic_symbols()[1])
+    except ElfError as e:
+        pass
+    library_exports[path] = ret
+    return ret
+
+
+def find_library(install_dir, name, dirs, elfclass):
+    """ Find the library the dynamic linker would load for name, preferring
+        the one we're building over the host copy. Returns the exported
+        symbols, or None when it cannot be found. """
+    if "/" in name:
+        dirs = [os.path.dirname(name)]
+        name = os.path.basename(name)
+    for d in dirs:
+        for root in (install_dir, "/"):
+            fpath = os.path.join(root, d.lstrip("/"), name)
+            if not os.path.exists(fpath):
+                continue
+            exports = get_library_exports(os.path.realpath(fpath))
+            if exports is not None and exports[0] == elfclass:
+                return exports[1]
+    return None
+
+
+def get_search_dirs(info):
+    """ rpaths come first, then the default search path """
+    dirs = search_model.get_rpaths(info)
+    dirs.extend(search_model.dirs32 if info.emul32 else search_model.dirs)
+    return dirs
+
+
+def find_unused_libraries(item):
+    """ DT_NEEDED entries of the file that provide none of its undefined
+        symbols. Libraries we cannot find are assumed to be used. """
+    install_dir, info = item
+    try:
+        with ElfFile(info.file) as elf:
+            elfclass = elf.elfclass
+            undefined = elf.get_dynamic_symbols()[0]
+    except ElfError as e:
+        return info.pretty, None
+
+    dirs = get_search_dirs(info)
+    unused = list()
+    for name in sorted(info.symbol_deps):
+        exports = find_library(install_dir, name, dirs, elfclass)
+        if exports is None:
+            continue
+        if undefined.isdisjoint(exports):
+            unused.append(name)
+    return info.pretty, unused
+
+
+def write_report(path, examinations):
+    """ Write the unused libraries of each file as JSON, per package """
+    ret = dict()
+    for name in sorted(examinations):
+        files = dict()
+        for info in examinations[name]:
+            if info.unused_libs:
+                files[info.pretty] = info.unused_libs
+        if len(files) > 0:
+            ret[name] = files
+    with open(path, "w") as out:
+        json.dump(ret, out, indent=1, sort_keys=True)
@@ -15,7 +15,7 @@
 #  (at your option) any later version.
 
 from . import console_ui
-from .stringglob import StringPathGlob
+from .stringglob import StringPathGlob, PatternTrie
 
 import os
 
@@ -23,6 +23,8 @@ PRIORITY_DEFAULT = 0    # Standard internal priority for a pattern
 PRIORITY_USER = 100     # Priority for a user pattern, do what they say.
 DBG = 1000              # Never allow the user to override these guys.
 
+MAX_SYMLINKS = 40       # Same limit as the kernel for symlink loops
+
 
 class DefaultPolicy(StringPathGlob):
 
@@ -47,9 +49,16 @@ class Package:
     # List of permanent files
     permanent = None
 
+    # Pattern that captured each path
+    captures = None
+
+    # Sorted file list, kept until the files change
+    emitted = None
+
     def __init__(self, name):
         self.name = name
         self.patterns = dict()
+        self.captures = dict()
         self.files = set()
         self.excludes = set()
         self.permanent = set()
@@ -63,6 +72,9 @@ class Package:
         """ Return a matching pattern for the given path.
             This is ordered according to priority to enable
             multiple layers of priorities """
+        if path in self.captures:
+            return self.captures[path]
+
         matches = [p for p in self.patterns if p.match(path)]
         if len(matches) == 0:
             return self.default_policy
@@ -77,37 +89,57 @@ class Package:
             pattern = self.default_policy
         if pattern not in self.patterns:
             self.patterns[pattern] = set()
+        # Recaptured by another pattern, so it moves over
+        prev = self.captures.get(path)
+        if prev is not None and prev is not pattern:
+            self.patterns[prev].discard(path)
         self.patterns[pattern].add(path)
+        self.captures[path] = pattern
         self.files.add(path)
+        self.emitted = None
         if permanent:
             self.permanent.add(path)
 
     def remove_file(self, path):
         """ Remove a file from this package if it owns it """
-        pat = self.get_pattern(path)
-        if not pat:
+        pat = self.captures.pop(path, None)
+        if pat is None:
             return
-        if path in self.patterns[pat]:
-            self.patterns[pat].remove(path)
-        if path in self.files:
-            self.files.remove(path)
+        self.patterns[pat].discard(path)
+        self.files.discard(path)
+        self.emitted = None
 
     def exclude_file(self, path):
         """ Exclude a file from this package if it captures it """
-        pat = self.get_pattern(path)
-        if not pat:
-            return
-        if path in self.files:
-            self.files.remove(path)
+        self.files.discard(path)
         self.excludes.add(path)
+        self.emitted = None
+
+    def exclude_files(self, paths):
+        """ Exclude many files at once, i.e. those stolen by others """
+        self.files.difference_update(paths)
+        self.excludes.update(paths)
+        self.emitted = None
 
     def emit_files(self):
-        """ Emit actual file lists, vs the globs we have """
-        ret = set()
+        """ Emit actual file lists, vs the globs we have. The sorted list is
+            shared between callers until the files change, so it must not be
+            modified. """
+        if self.emitted is None:
+            self.emitted = sorted(self.iter_files())
+        return self.emitted
+
+    def iter_files(self):
+        """ Iterate the actual files in no particular order, without
+            building a sorted copy. Each path is only captured once. """
+        if self.emitted is not None:
+            for path in self.emitted:
+                yield path
+            return
         for pt in self.patterns:
-            adds = [x for x in self.patterns[pt] if x not in self.excludes]
-            ret.update(adds)
-        return sorted(ret)
+            for path in self.patterns[pt]:
+                if path not in self.excludes:
+                    yield path
 
     def is_permanent(self, path):
         """ Determine if a path if a permanent path or not """
@@ -138,10 +170,23 @@ class PackageGenerator:
     packages = None
     permanent = None
 
-    def __init__(self, spec):
+    # Reverse map of path to owning package
+    owners = None
+    # Root used to resolve symlinks, i.e. $installdir
+    install_dir = None
+    # Cache of resolved paths within install_dir, symlinks don't change
+    # once we start packaging
+    resolved = None
+    # Patterns compiled for matching, rebuilt once they change
+    compiled = None
+
+    def __init__(self, spec, install_dir=None):
         self.patterns = dict()
         self.packages = dict()
         self.permanent = set()
+        self.owners = dict()
+        self.resolved = dict()
+        self.install_dir = install_dir
 
         if spec.pkg_permanent:
             for perm in spec.pkg_permanent:
@@ -243,6 +288,8 @@ class PackageGenerator:
         if target not in self.packages:
             self.packages[target] = Package(target)
         self.packages[target].add_file(pattern, path, permanent)
+        if path not in self.owners:
+            self.owners[path] = self.packages[target]
 
     def remove_file(self, path):
         """ Remove a file from our set, in any of our main or sub packages
@@ -250,18 +297,16 @@ class PackageGenerator:
 
         for pkg in self.packages:
             self.packages[pkg].remove_file(path)
+        if path in self.owners:
+            del self.owners[path]
 
     def get_pattern(self, path):
         """ Return a matching pattern for the given path.
             This is ordered according to priority to enable
             multiple layers of priorities """
-        matches = [p for p in self.patterns if p.match(path)]
-        if len(matches) == 0:
-            return None
-
-        matches = sorted(matches, key=StringPathGlob.get_priority,
-                         reverse=True)
-        return matches[0]
+        if self.compiled is None:
+            self.compiled = PatternTrie(self.patterns)
+        return self.compiled.match(path)
 
     def add_pattern(self, pattern, pkgName, priority=PRIORITY_DEFAULT):
         """ Add a pattern to the internal map according to the
@@ -275,6 +320,7 @@ class PackageGenerator:
 
         obj = StringPathGlob(pattern, prefixMatch=is_prefix, priority=priority)
         self.patterns[obj] = pkgName
+        self.compiled = None
 
     def add_permanent_pattern(self, pattern):
         """ Add a pattern to our mapping of permanent paths. """
@@ -292,22 +338,82 @@ class PackageGenerator:
             exclusion to take place, and then return all package objects
             that we've managed to generate. There is no gaurantee that
             a "main" package will be generated, as patterns may omit
-            the production of one. """
-
-        for package in self.packages:
-            for comparison in self.packages:
-                if comparison == package:
-                    continue
-                for file in self.packages[comparison].emit_files():
-                    self.packages[package].exclude_file(file)
+            the production of one.
+
+            Each file ends up in the last package (in creation order) that
+            captured it, which is what giving up everything captured by any
+            other package, one package at a time, amounts to. """
+
+        # Final owner of every path, and the paths each package gave up
+        table = dict()
+        lost = dict()
+        for package in self.packages.values():
+            for pattern, paths in package.patterns.items():
+                for path in paths:
+                    if path in package.excludes:
+                        continue
+                    prev = table.get(path)
+                    if prev is not None and prev[0] is not package:
+                        if prev[0].name not in lost:
+                            lost[prev[0].name] = set()
+                        lost[prev[0].name].add(path)
+                    table[path] = (package, pattern)
+
+        for name in lost:
+            self.packages[name].exclude_files(lost[name])
+        for path in table:
+            self.owners[path] = table[path][0]
+
+    def resolve_path(self, path):
+        """ Resolve symlinks in path as though install_dir were the root,
+            never looking outside of it """
+        if path in self.resolved:
+            return self.resolved[path]
+
+        parts = path.split(os.sep)
+        parts.reverse()
+        ret = list()
+        links = 0
+        while len(parts) > 0:
+            part = parts.pop()
+            if part == "" or part == ".":
+                continue
+            if part == "..":
+                if len(ret) > 0:
+                    ret.pop()
+                continue
+            fpath = os.path.join(self.install_dir, *(ret + [part]))
+            if not os.path.islink(fpath):
+                ret.append(part)
+                continue
+            links += 1
+            if links > MAX_SYMLINKS:
+                ret = None
+                break
+            target = os.readlink(fpath)
+            if target.startswith(os.sep):
+                ret = list()
+            parts.extend(reversed(target.split(os.sep)))
+
+        if ret is not None:
+            ret = os.sep + os.sep.join(ret)
+        self.resolved[path] = ret
+        return ret
+
+    def get_owner(self, path):
+        """ Owner of exactly this path, verifying it still holds it, as
+            examination removes files from the packages directly """
+        package = self.owners.get(path)
+        if package and path in package.files:
+            return package
+        return None
 
     def get_file_owner(self, file):
         """ Return the owning package for the specified file """
-        rname = os.path.realpath(file)
-        for pkg in self.packages:
-            package = self.packages[pkg]
-            if file in package.files:
-                return package
-            elif rname in package.files:
-                return package
-        return None
+        package = self.get_owner(file)
+        if package or not self.install_dir:
+            return package
+        rname = self.resolve_path(file)
+        if not rname or rname == file:
+            return None
+        return self.get_owner(rname)
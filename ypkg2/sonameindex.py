@@ -0,0 +1,315 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of ypkg2
+#
+#  Copyright 2015-2017 Ikey Doherty <ikey@solus-project.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+
+from . import console_ui
+
+import inary.context
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+
+DEFAULT_INDEX_PATH = "/var/cache/ypkg/soname.index"
+DEFAULT_PKGCONFIG_INDEX_PATH = "/var/cache/ypkg/pkgconfig.index"
+
+INDEX_MAGIC = b"YSNI"
+INDEX_VERSION = 1
+PKGCONFIG_INDEX_VERSION = 1
+
+# magic, version, installdb mtime, installed package count, record count
+index_header = struct.Struct("<4sIQII")
+# path offset, path length, ELF class, package offset
+index_record = struct.Struct("<IHBxI")
+
+# ELF class of a library, 0 meaning "any", i.e. linker scripts
+CLASS_ANY = 0
+CLASS_32 = 1
+CLASS_64 = 2
+
+lib_match = re.compile(r".*\.so(\.|$)")
+
+
+def get_installdb_stamp():
+    """ Identify the current generation of the InstallDB. Every install,
+        removal or upgrade changes the package directories within it. """
+    pdir = inary.context.config.packages_dir()
+    st = os.stat(pdir)
+    return st.st_mtime_ns, len(os.listdir(pdir))
+
+
+def get_elf_class(path):
+    """ ELF class of the given library, or None if it doesn't exist """
+    try:
+        with open(path, "rb") as inp:
+            ident = inp.read(5)
+    except Exception as e:
+        return None
+    if len(ident) < 5 or ident[0:4] != b"\x7fELF":
+        return CLASS_ANY
+    if ident[4] in (CLASS_32, CLASS_64):
+        return ident[4]
+    return CLASS_ANY
+
+
+def write_atomic(path, prefix, data):
+    """ Replace the file at path with data, never leaving it half written """
+    dirn = os.path.dirname(path)
+    if not os.path.exists(dirn):
+        os.makedirs(dirn, mode=0o0755)
+    fd, tmp = tempfile.mkstemp(dir=dirn, prefix=prefix)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in data:
+                out.write(chunk)
+        os.chmod(tmp, 0o0644)
+        os.rename(tmp, path)
+    except Exception as e:
+        os.unlink(tmp)
+        raise
+
+
+class SonameIndex:
+    """ Prebuilt mapping of every installed library path (and its ELF class)
+        to the owning package, allowing DT_NEEDED lookups without hitting the
+        filesystem or FilesDB. The file is a sorted table of fixed size
+        records over a string pool, searched in place via mmap. """
+
+    path = None
+    stamp = None
+    packages = 0
+    count = 0
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        self.map = None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def load(self):
+        """ Map the index, returning False if it is missing or corrupt """
+        self.close()
+        try:
+            with open(self.path, "rb") as inp:
+                self.map = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, mtime, self.packages, self.count = \
+                index_header.unpack_from(self.map, 0)
+        except Exception as e:
+            self.close()
+            return False
+        size = index_header.size + self.count * index_record.size
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or \
+                len(self.map) < size:
+            self.close()
+            return False
+        self.stamp = (mtime, self.packages)
+        return True
+
+    def is_stale(self):
+        """ Index no longer describes the InstallDB """
+        if self.map is None:
+            return True
+        try:
+            return self.stamp != get_installdb_stamp()
+        except Exception as e:
+            return True
+
+    def get_record(self, i):
+        """ Return (path, class, package) for the i'th record """
+        off = index_header.size + i * index_record.size
+        poff, plen, cls, koff = index_record.unpack_from(self.map, off)
+        path = self.map[poff:poff + plen]
+        end = self.map.find(b"\0", koff)
+        return path, cls, self.map[koff:end].decode("utf-8")
+
+    def lookup(self, path, emul32=False):
+        """ Owner of the library at path, matching the wanted ELF class """
+        if self.map is None:
+            return None
+        want = CLASS_32 if emul32 else CLASS_64
+        key = path.encode("utf-8")
+
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # Same path may be listed once per class
+        while lo < self.count:
+            rpath, cls, pkg = self.get_record(lo)
+            if rpath != key:
+                break
+            if cls == want or cls == CLASS_ANY:
+                return pkg
+            lo += 1
+        return None
+
+    def entries(self):
+        """ Yield (path, class, package) for every record """
+        if self.map is None:
+            return
+        for i in range(0, self.count):
+            path, cls, pkg = self.get_record(i)
+            yield path.decode("utf-8", "surrogateescape"), cls, pkg
+
+    def rebuild(self, idb):
+        """ Regenerate the index from the given InstallDB """
+        stamp = get_installdb_stamp()
+        owners = dict()
+        conflicts = set()
+        for pkg in idb.list_installed():
+            for file in idb.get_files(pkg).list:
+                path = "/" + file.path
+                if not lib_match.match(path):
+                    continue
+                if path in owners and owners[path] != pkg:
+                    # Let the FilesDB path deal with these
+                    conflicts.add(path)
+                    continue
+                owners[path] = pkg
+
+        records = list()
+        for path in owners:
+            if path in conflicts:
+                continue
+            cls = get_elf_class(path)
+            if cls is None:
+                continue
+            records.append((path.encode("utf-8", "surrogateescape"), cls,
+                            owners[path]))
+        records.sort()
+
+        # Intern package names in the pool, paths follow them
+        pool = bytearray()
+        pool_base = index_header.size + len(records) * index_record.size
+        pkg_offsets = dict()
+        table = bytearray()
+        for path, cls, pkg in records:
+            if pkg not in pkg_offsets:
+                pkg_offsets[pkg] = pool_base + len(pool)
+                pool += pkg.encode("utf-8") + b"\0"
+            table += index_record.pack(pool_base + len(pool), len(path), cls,
+                                       pkg_offsets[pkg])
+            pool += path
+
+        header = index_header.pack(INDEX_MAGIC, INDEX_VERSION, stamp[0],
+                                   stamp[1], len(records))
+
+        self.close()
+        write_atomic(self.path, ".soname-index", [header, table, pool])
+        return len(records)
+
+    def emit_stats(self):
+        state = "stale" if self.is_stale() else "current"
+        console_ui.emit_info("Index", "{}: {} libraries from {} packages, {}".
+                             format(self.path, self.count, self.packages,
+                                    state))
+
+
+class PkgconfigIndex:
+    """ pkgconfig() and pkgconfig32() names of every installed package,
+        mapped to the provider. Reading the metadata of every package is
+        far too slow to repeat on each build, so the index is kept on disk
+        until the InstallDB changes. """
+
+    path = None
+    stamp = None
+
+    pkgconfigs = None
+    pkgconfigs32 = None
+
+    def __init__(self, path=DEFAULT_PKGCONFIG_INDEX_PATH):
+        self.path = path
+        self.pkgconfigs = dict()
+        self.pkgconfigs32 = dict()
+
+    def load(self):
+        """ Read the index, returning False if it is missing or corrupt """
+        try:
+            with open(self.path, "r") as inp:
+                data = json.load(inp)
+            if data["version"] != PKGCONFIG_INDEX_VERSION:
+                return False
+            stamp = tuple(data["stamp"])
+            pkgconfigs = dict(data["pkgconfig"])
+            pkgconfigs32 = dict(data["pkgconfig32"])
+        except Exception as e:
+            return False
+        self.stamp = stamp
+        self.pkgconfigs = pkgconfigs
+        self.pkgconfigs32 = pkgconfigs32
+        return True
+
+    def is_stale(self):
+        """ Index no longer describes the InstallDB """
+        if self.stamp is None:
+            return True
+        try:
+            return self.stamp != get_installdb_stamp()
+        except Exception as e:
+            return True
+
+    def build(self, idb):
+        """ Index the given InstallDB in memory. The metadata has no
+            pkgconfig32() distinction, so we go by the names of our emul32
+            subpackages instead. """
+        self.stamp = get_installdb_stamp()
+        self.pkgconfigs = dict()
+        self.pkgconfigs32 = dict()
+        for name in idb.list_installed():
+            try:
+                provides = idb.get_package(name).providesPkgConfig
+            except Exception as e:
+                continue
+            if not provides:
+                continue
+            if name.endswith("-32bit-devel") or name.endswith("-32bit"):
+                target = self.pkgconfigs32
+            else:
+                target = self.pkgconfigs
+            for pc in provides:
+                target[str(pc)] = name
+        return len(self.pkgconfigs) + len(self.pkgconfigs32)
+
+    def save(self):
+        """ Write the index out for the following builds """
+        data = {
+            "version": PKGCONFIG_INDEX_VERSION,
+            "stamp": list(self.stamp),
+            "pkgconfig": self.pkgconfigs,
+            "pkgconfig32": self.pkgconfigs32,
+        }
+        blob = json.dumps(data, sort_keys=True).encode("utf-8")
+        write_atomic(self.path, ".pkgconfig-index", [blob])
+
+    def rebuild(self, idb):
+        """ Regenerate the index from the given InstallDB """
+        count = self.build(idb)
+        self.save()
+        return count
+
+    def emit_stats(self):
+        state = "stale" if self.is_stale() else "current"
+        console_ui.emit_info("Index", "{}: {} pkgconfig and {} pkgconfig32 "
+                             "providers, {}".format(self.path,
+                                                    len(self.pkgconfigs),
+                                                    len(self.pkgconfigs32),
+                                                    state))
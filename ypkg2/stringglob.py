@@ -13,19 +13,32 @@
 
 import fnmatch
 import os
+import re
 
 
 class StringPathGlob:
+    """ Matches paths against a glob, segment by segment. Everything about
+        the pattern is worked out up front, as each glob is tested against
+        every file we package. """
 
-    pattern = None
-    prefixMatch = False
-    priority = 0
+    __slots__ = ["pattern", "prefixMatch", "priority", "segments",
+                 "can_prefix"]
 
     def __init__(self, pattern, prefixMatch=False, priority=0):
         self.pattern = pattern
         self.prefixMatch = prefixMatch
         self.priority = priority
 
+        # (segment, compiled match) with no match for literal segments
+        self.segments = list()
+        for elem in pattern.split(os.sep):
+            match = None
+            if StringPathGlob.is_a_pattern(elem):
+                match = re.compile(fnmatch.translate(elem)).match
+            self.segments.append((elem, match))
+        self.can_prefix = prefixMatch and pattern.endswith(os.sep) and \
+            not StringPathGlob.is_a_pattern(pattern)
+
     @staticmethod
     def is_a_pattern(item):
         if "[" in item or "?" in item or "*" in item:
@@ -34,34 +47,17 @@ class StringPathGlob:
 
     def match(self, path):
         if self.prefixMatch:
-            if self.pattern.endswith(os.sep) and not \
-              StringPathGlob.is_a_pattern(self.pattern):
-                if path.startswith(self.pattern):
-                    return True
-            return False
+            return self.can_prefix and path.startswith(self.pattern)
 
-        our_splits = self.pattern.split(os.sep)
         test_splits = path.split(os.sep)
-
-        their_len = len(test_splits)
-        our_len = len(our_splits)
-
-        if our_len > their_len:
+        if len(self.segments) > len(test_splits):
             return False
 
-        for i in range(0, our_len):
-            our_elem = our_splits[i]
-            their_elem = test_splits[i]
-
+        for (our_elem, match), their_elem in zip(self.segments, test_splits):
             if our_elem == their_elem:
                 continue
-
-            if StringPathGlob.is_a_pattern(our_elem):
-                if not fnmatch.fnmatchcase(their_elem, our_elem):
-                    return False
-            else:
+            if match is None or not match(their_elem):
                 return False
-
         return True
 
     def __str__(self):
@@ -81,3 +77,103 @@ class StringPathGlob:
 
     def get_priority(self):
         return self.priority
+
+
+class PatternNode:
+    """ One path segment within a PatternTrie """
+
+    # Literal segment -> PatternNode
+    literals = None
+    # (segment, compiled match, PatternNode) for glob segments
+    globs = None
+
+    # Best (rank, pattern) matching any path reaching this node
+    match = None
+    # Best (rank, prefix pattern), requiring at least one more segment
+    prefix = None
+    # Best rank of any pattern at or below this node
+    best = None
+
+    def __init__(self):
+        self.literals = dict()
+        self.globs = list()
+
+    def get_child(self, segment, match):
+        if match is None:
+            if segment not in self.literals:
+                self.literals[segment] = PatternNode()
+            return self.literals[segment]
+        for glob in self.globs:
+            if glob[0] == segment:
+                return glob[2]
+        node = PatternNode()
+        self.globs.append((segment, match, node))
+        return node
+
+
+class PatternTrie:
+    """ A set of StringPathGlobs compiled into a trie of path segments, so
+        the highest priority match is found in one walk of the path rather
+        than testing each pattern in turn. Equal priorities are won by the
+        pattern that came first, as with a stable sort. """
+
+    root = None
+
+    def __init__(self, patterns):
+        self.root = PatternNode()
+        for index, pattern in enumerate(patterns):
+            self.add(pattern, (pattern.priority, -index))
+
+    def add(self, pattern, rank):
+        """ Insert the pattern, keeping the best rank along the way """
+        segments = pattern.segments
+        if pattern.prefixMatch:
+            if not pattern.can_prefix:
+                # Never matches anything
+                return
+            # Drop the empty segment following the trailing separator
+            segments = segments[:-1]
+
+        node = self.root
+        nodes = [node]
+        for segment, match in segments:
+            node = node.get_child(segment, match)
+            nodes.append(node)
+
+        entry = (rank, pattern)
+        if pattern.prefixMatch:
+            if node.prefix is None or node.prefix[0] < rank:
+                node.prefix = entry
+        elif node.match is None or node.match[0] < rank:
+            node.match = entry
+        for node in nodes:
+            if node.best is None or node.best < rank:
+                node.best = rank
+
+    def match(self, path):
+        """ Return the highest priority pattern matching path, if any """
+        segments = path.split(os.sep)
+        count = len(segments)
+        best = None
+        stack = [(self.root, 0)]
+        while len(stack) > 0:
+            node, depth = stack.pop()
+            if node.best is None or (best is not None and
+                                     node.best <= best[0]):
+                continue
+            if node.match and (best is None or best[0] < node.match[0]):
+                best = node.match
+            if depth >= count:
+                continue
+            if node.prefix and (best is None or best[0] < node.prefix[0]):
+                best = node.prefix
+            segment = segments[depth]
+            child = node.literals.get(segment)
+            if child is not None:
+                stack.append((child, depth + 1))
+            for glob, match, child in node.globs:
+                if glob == segment or match(segment):
+                    stack.append((child, depth + 1))
+        if best is None:
+            return None
+        return best[1]
@@ -33,6 +33,10 @@ except Exception as e:
     from yaml import Loader
 
 
+# Supported ELF compression for the split debug files
+DEBUG_COMPRESSION = ["zlib", "zstd"]
+
+
 class PackageSanity:
 
     @staticmethod
@@ -98,6 +102,7 @@ class YpkgSpec:
     pkg_extract = True
     pkg_optimize = None
     pkg_libsplit = True
+    pkg_debugcompress = None
 
     # Only used by solbuild
     pkg_networking = False
@@ -219,6 +224,7 @@ class YpkgSpec:
             ("conflicts", MultimapFormat(self, self.add_conflict, "main")),
             ("replaces", MultimapFormat(self, self.add_replace, "main")),
             ("optimize", OneOrMoreString),
+            ("debugcompress", str),
         ])
         # Build steps are handled separately
         self.build_steps = OrderedDict([
@@ -368,6 +374,13 @@ class YpkgSpec:
             console_ui.emit_error("YAML", "No functional build steps found")
             return False
 
+        if self.pkg_debugcompress and \
+                self.pkg_debugcompress not in DEBUG_COMPRESSION:
+            console_ui.emit_error("YAML:debugcompress",
+                                  "Unsupported compression: {}".format(
+                                   self.pkg_debugcompress))
+            return False
+
         # Validate the names and version
         if not PackageSanity.is_version_valid(self.pkg_version):
             return False